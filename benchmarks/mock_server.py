@@ -0,0 +1,318 @@
+'''
+Local stand-in for itch.io and reddit, for the benchmarks
+
+Every page is built from the recorded pages in fixtures/, the site is described by MockSite.
+The server runs in its own process so it doesn't compete with the benchmarked code for the GIL.
+Requests of a requests session reach it once the session is routed to it:
+
+    with MockServer(MockSite()) as server:
+        server.route(fetcher.session)
+        get_from_itch_group('https://itch.io/c/1/collection-1', fetcher=fetcher)
+
+Run it directly to look at the pages in a browser:
+    python benchmarks/mock_server.py [port]
+'''
+
+import os
+import sys
+import re
+import json
+import gzip
+import hashlib
+import argparse
+import subprocess
+from string import Template
+from functools import lru_cache
+from urllib.parse import urlsplit, urlunsplit, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from requests.adapters import HTTPAdapter
+
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+# claim() outcomes of the games, game n has the outcome GAME_OUTCOMES[n % len(GAME_OUTCOMES)]
+GAME_OUTCOMES = ('claim', 'claimed', 'dl_only', 'dl_only_sale', 'always_free', 'buy', 'preorder', 'web', 'removed')
+
+
+# first game number of each kind of page, so games don't overlap between pages
+COLLECTION_GAMES = 10**6 # + collection * 10**5
+SALE_GAMES = 10**9       # + sale * 10**5
+COMMENT_GAMES = 2 * 10**9
+
+
+SALE_END = '2030-01-01 00:00:00'
+
+
+@lru_cache(maxsize=None)
+def fixture(name):
+    with open(os.path.join(FIXTURES, name), encoding='utf-8') as f:
+        return f.read()
+
+
+def game_url(n):
+    return f'https://dev{n % 500}.itch.io/{GAME_OUTCOMES[n % len(GAME_OUTCOMES)]}-{n}'
+
+
+class MockSite:
+    '''
+    the pages the mock server has, all numbers are per page
+      collections        number of collections, https://itch.io/c/<n>/collection-<n>
+      collection_pages   pages of each collection
+      games_per_page     games in a page of a collection
+      sales              number of sales, https://itch.io/s/<n>/sale-<n>, and ended sales, .../ended-sale-<n>
+      sale_games         games in a sale
+      more_every         every more_every-th game of a collection/sale is connected to more sales
+      comments           comments in a reddit thread, https://old.reddit.com/r/<sub>/comments/<id>/<title>/
+      top_comments       comments in the first page of a thread, the others are collapsed
+      links_per_comment  game links in a comment
+      groups_every       every groups_every-th comment also links a collection, a sale and an ended sale
+      library_pages      pages of https://itch.io/my-purchases
+    '''
+    def __init__(self, collections=4, collection_pages=10, games_per_page=30, sales=4, sale_games=60, more_every=10,
+                 comments=1000, top_comments=200, links_per_comment=3, groups_every=50, library_pages=5):
+        self.collections = collections
+        self.collection_pages = collection_pages
+        self.games_per_page = games_per_page
+        self.sales = sales
+        self.sale_games = sale_games
+        self.more_every = more_every
+        self.comments = comments
+        self.top_comments = top_comments
+        self.links_per_comment = links_per_comment
+        self.groups_every = groups_every
+        self.library_pages = library_pages
+
+    def to_json(self):
+        return json.dumps(vars(self))
+
+    @classmethod
+    def from_json(cls, text):
+        return cls(**json.loads(text))
+
+    def collection_url(self, n):
+        return f'https://itch.io/c/{n}/collection-{n}'
+
+    def sale_url(self, n, ended=False):
+        return f"https://itch.io/s/{n}/{'ended-' if ended else ''}sale-{n}"
+
+    def thread_url(self, thread='mock01'):
+        return f'https://old.reddit.com/r/FreeGameFindings/comments/{thread}/itchio_mega_thread/'
+
+    def sources(self):
+        '''a reddit thread, a collection and a sale, like SOURCES'''
+        return {self.thread_url(), self.collection_url(0), self.sale_url(0)}
+
+    # pages
+
+    def cells(self, games):
+        cell = Template(fixture('itch_game_cell.html'))
+        return '\n'.join(cell.safe_substitute(game_id=n, url=game_url(n), title=f'Game {n}', author=f'dev{n % 500}',
+                                              author_url=f'https://dev{n % 500}.itch.io',
+                                              blurb=fixture('itch_blurb.html') if n % self.more_every == 0 else '')
+                         for n in games)
+
+    def collection(self, n, page):
+        if n >= self.collections or not 1 <= page <= self.collection_pages:
+            return None
+        first = COLLECTION_GAMES + n * 10**5 + (page - 1) * self.games_per_page
+        return Template(fixture('itch_collection.html')).safe_substitute(
+            id=n, title=f'Collection {n}', next_page=page + 1, cells=self.cells(range(first, first + self.games_per_page)))
+
+    def sale(self, n, ended):
+        if n >= self.sales:
+            return None
+        first = SALE_GAMES + n * 10**5
+        page = fixture('itch_sale_ended.html' if ended else 'itch_sale.html')
+        return Template(page).safe_substitute(id=n, title=f'Sale {n}', end_date=SALE_END,
+                                              cells=self.cells(range(first, first + self.sale_games)))
+
+    def library(self, page):
+        if not 1 <= page <= self.library_pages:
+            return None
+        games = [COMMENT_GAMES + i * len(GAME_OUTCOMES) + GAME_OUTCOMES.index('claimed') for i in range(page * 30 - 30, page * 30)]
+        return Template(fixture('itch_collection.html')).safe_substitute(
+            id=0, title='My purchases', next_page=page + 1, cells=self.cells(games))
+
+    def game(self, slug):
+        outcome, _, n = slug.rpartition('-')
+        if outcome not in GAME_OUTCOMES or not n.isdigit():
+            return None
+        n = int(n)
+        sale = n % max(self.sales, 1)
+        sales = f'<div class="game_sales"><a href="{self.sale_url(sale)}">Part of Sale {sale}</a></div>'
+        return Template(fixture(f'itch_game_{outcome}.html')).safe_substitute(
+            game_id=n, title=f'Game {n}', author=f'dev{n % 500}', slug=slug, sales=sales)
+
+    def comment(self, thread, k):
+        '''the t1 of comment number `k`'''
+        first = COMMENT_GAMES + k * self.links_per_comment
+        links = [game_url(n) for n in range(first, first + self.links_per_comment)]
+        if k % self.groups_every == 0 and self.collections and self.sales:
+            group = k // self.groups_every
+            links += [self.collection_url(group % self.collections), self.sale_url(group % self.sales),
+                      self.sale_url(group % self.sales, ended=True)]
+        items = '\n'.join(f'<li><a href="{link}">{link}</a></li>' for link in links)
+        body = Template(fixture('reddit_comment.html')).safe_substitute(items=items)
+        t1 = json.loads(Template(fixture('reddit_thread.json')).safe_substitute(thread=thread, id=f'c{k}'))[1]['data']['children'][0]
+        t1['data'].update({'body': body, 'body_html': escape(body), 'created_utc': 1596672000.0 + k})
+        return t1
+
+    def comment_ids(self, ids):
+        return [int(id[1:]) for id in ids if re.fullmatch(r'c\d+', id) and int(id[1:]) < self.comments]
+
+    def thread(self, thread, chain=None):
+        data = json.loads(Template(fixture('reddit_thread.json')).safe_substitute(thread=thread, id='c0'))
+        more = data[1]['data']['children'][1]
+        if chain is not None:
+            data[1]['data']['children'] = [self.comment(thread, k) for k in self.comment_ids([chain])]
+        else:
+            top = min(self.comments, self.top_comments)
+            more['data'].update({'count': self.comments - top, 'children': [f'c{k}' for k in range(top, self.comments)]})
+            data[1]['data']['children'] = [self.comment(thread, k) for k in range(top)] + ([more] if top < self.comments else [])
+        return json.dumps(data)
+
+    def more_children(self, thread, ids):
+        data = json.loads(fixture('reddit_more_children.json'))
+        data['json']['data']['things'] = [self.comment(thread, k) for k in self.comment_ids(ids)]
+        return json.dumps(data)
+
+    def page(self, path, query):
+        '''
+        INPUTS  path and query of a url of itch.io or reddit
+        OUTPUT  body, content type, or None if there's no such page
+        '''
+        query = parse_qs(query)
+        page = int(query.get('page', ['1'])[0])
+        match = re.fullmatch(r'/c/(\d+)/[^/]+', path)
+        if match:
+            return self.collection(int(match[1]), page), 'text/html'
+        match = re.fullmatch(r'/s/(\d+)/(ended-)?sale-\d+', path)
+        if match:
+            return self.sale(int(match[1]), match[2] is not None), 'text/html'
+        match = re.fullmatch(r'/r/[^/]+/comments/([^/]+)(?:/thread/([^/]+))?\.json', path)
+        if match:
+            return self.thread(match[1], match[2]), 'application/json'
+        if path == '/api/morechildren.json':
+            thread = query.get('link_id', ['t3_'])[0][3:]
+            return self.more_children(thread, query.get('children', [''])[0].split(',')), 'application/json'
+        if path == '/my-purchases':
+            return self.library(page), 'text/html'
+        match = re.fullmatch(r'/([^/]+)', path)
+        if match:
+            return self.game(match[1]), 'text/html'
+        return None, 'text/html'
+
+
+def escape(text):
+    '''html escaping like reddit's body_html'''
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('"', '&quot;')
+
+
+@lru_cache(maxsize=4096)
+def respond(site, path, query, compress):
+    '''status, body, content type, etag of a page of `site`, pages are built once'''
+    body, content_type = site.page(path, query)
+    if body is None:
+        return 404, b'not found', 'text/plain', None
+    body = body.encode('utf-8')
+    etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+    return 200, gzip.compress(body, 5) if compress else body, content_type, etag
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive, like itch.io and reddit
+    # headers and body are sent together, otherwise delayed acks add 40ms to every keep-alive response
+    wbufsize = -1
+    disable_nagle_algorithm = True
+    site = None
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        compress = 'gzip' in self.headers.get('Accept-Encoding', '')
+        status, body, content_type, etag = respond(self.site, parts.path, parts.query, compress)
+        if etag is not None and self.headers.get('If-None-Match') == etag:
+            status, body = 304, b''
+        self.send_response(status)
+        self.send_header('Content-Type', f'{content_type}; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        if etag is not None:
+            self.send_header('ETag', etag)
+        if compress and status == 200:
+            self.send_header('Content-Encoding', 'gzip')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MockAdapter(HTTPAdapter):
+    '''sends the requests of a session to the mock server, whatever their host is'''
+    def __init__(self, address, **kwargs):
+        super().__init__(**kwargs)
+        self.address = address
+
+    def send(self, request, **kwargs):
+        parts = urlsplit(request.url)
+        request.url = urlunsplit(('http', self.address, parts.path, parts.query, ''))
+        return super().send(request, **kwargs)
+
+
+class MockServer:
+    '''
+    the mock server in a child process, started by `with MockServer(site) as server` or start()
+      site  a MockSite
+    '''
+    def __init__(self, site=None):
+        self.site = site or MockSite()
+        self.process = None
+        self.address = None
+
+    def start(self):
+        self.process = subprocess.Popen([sys.executable, os.path.abspath(__file__), '0', '--site', self.site.to_json()],
+                                        stdout=subprocess.PIPE, text=True)
+        # the first line is "serving on http://host:port"
+        self.address = self.process.stdout.readline().split('//')[1].strip()
+        return self
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+        self.process.stdout.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def route(self, session):
+        '''Send all the requests of the requests session `session` to the server, keeping its pool and retries'''
+        adapter = session.get_adapter('https://')
+        mock = MockAdapter(self.address, pool_connections=adapter._pool_connections,
+                           pool_maxsize=adapter._pool_maxsize, max_retries=adapter.max_retries)
+        session.mount('https://', mock)
+        session.mount('http://', mock)
+        return session
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Serve mock itch.io and reddit pages built from the fixtures')
+    arg_parser.add_argument('port', nargs='?', type=int, default=8000, help='port to listen on, 0 picks a free port (default: 8000)')
+    arg_parser.add_argument('--site', default='{}', help='MockSite arguments as json')
+    args = arg_parser.parse_args()
+
+    Handler.site = MockSite.from_json(args.site)
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), Handler)
+    server.daemon_threads = True
+    host, port = server.server_address[:2]
+    print(f'serving on http://{host}:{port}', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,436 @@
+'''
+Repeatable benchmarks of claim_itch.py, without itch.io or reddit
+
+Pages come from the mock server (see mock_server.py), which builds them from the recorded pages in fixtures/.
+Requests are not paced, so the times are the time of the code, the local network and the mock server.
+
+    python benchmarks/run.py --output before.json
+    (change claim_itch.py)
+    python benchmarks/run.py --output after.json --compare before.json
+
+The results are json: for each benchmark and its parameters, the seconds of each run (per call if it's
+called more than once per run) and their min / median / mean. --compare exits with 1 if a median got slower
+by more than --threshold, so it can be used to check for regressions between versions.
+'''
+
+import os
+import sys
+import io
+import json
+import time
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+import contextlib
+import importlib.util
+from datetime import datetime, timezone
+
+from mock_server import MockSite, MockServer, GAME_OUTCOMES, game_url
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_SCRIPT = os.path.join(ROOT, 'claim_itch.py')
+
+
+# history sizes (number of game urls) for the history benchmarks, see --sizes
+HISTORY_SIZES = (10**4, 10**5, 10**6)
+
+
+BENCHMARKS = dict() # name: generator function of Case, see benchmark()
+REQUIRES = dict()   # name: what the benchmark uses from claim_itch.py, see benchmark()
+
+
+class Case:
+    '''
+    one measurement of a benchmark
+      params  dict describing the case, it identifies the case when comparing results
+      run     function that's timed, it can return a dict of counters that are added to the result
+      setup   function called before each run, it isn't timed
+      number  times `run` is called in a run, the result is the time per call
+    '''
+    def __init__(self, params, run, setup=None, number=1):
+        self.params = params
+        self.run = run
+        self.setup = setup
+        self.number = number
+
+
+def benchmark(name, requires=()):
+    '''
+    Register a benchmark, the decorated function gets the benchmark context (see Context)
+    and yields a Case for each set of parameters
+    `requires` are the names the benchmark uses from claim_itch.py, it's skipped for versions without them
+    '''
+    def register(function):
+        BENCHMARKS[name] = function
+        REQUIRES[name] = requires
+        return function
+    return register
+
+
+class Context:
+    '''what the benchmarks share: the benchmarked module, the mock server and a temporary directory'''
+    def __init__(self, ci, server, site, temp_dir, sizes):
+        self.ci = ci
+        self.server = server
+        self.site = site
+        self.temp_dir = temp_dir
+        self.sizes = sizes
+
+    def fetcher(self, cache=None):
+        '''a Fetcher without pacing, whose requests go to the mock server'''
+        fetcher = self.ci.Fetcher(host_rate=None, cache=cache)
+        self.server.route(fetcher.session)
+        return fetcher
+
+    def path(self, name):
+        '''a path in a new empty directory'''
+        directory = tempfile.mkdtemp(dir=self.temp_dir)
+        return os.path.join(directory, name)
+
+    def forget_history_stores(self):
+        stores = getattr(self.ci, 'HISTORY_STORES', dict())
+        for store in stores.values():
+            store.connection.close()
+        stores.clear()
+
+
+def requests_of(fetcher):
+    return {'requests': sum(stats['requests'] for stats in fetcher.stats.values()),
+            'bytes': sum(stats['bytes'] for stats in fetcher.stats.values())}
+
+
+# parsing, without the mock server
+
+
+@benchmark('extract_from_itch_group', requires=('extract_from_itch_group',))
+def bench_extract_from_itch_group(context):
+    for cells in (30, 3000):
+        page = MockSite(games_per_page=cells).collection(0, 1).encode('utf-8')
+        yield Case({'cells': cells}, lambda page=page: context.ci.extract_from_itch_group(page),
+                   number=max(1, 3000 // cells))
+
+
+@benchmark('extract_sale_end', requires=('extract_sale_end',))
+def bench_extract_sale_end(context):
+    page = MockSite().sale(0, ended=False).encode('utf-8')
+    yield Case({}, lambda: context.ci.extract_sale_end(page), number=1000)
+
+
+@benchmark('extract_from_reddit_listing', requires=('extract_from_reddit_listing',))
+def bench_extract_from_reddit_listing(context):
+    site = MockSite(comments=200, top_comments=200)
+    data = json.loads(site.thread('mock01'))
+    yield Case({'comments': 200}, lambda: context.ci.extract_from_reddit_listing(data, 'mock.json'), number=10)
+
+
+@benchmark('classify_page', requires=('classify_page_state', 'page_state_from_html'))
+def bench_classify_page(context):
+    ci = context.ci
+    site = MockSite()
+    pages = [site.game(f'{outcome}-{n}').encode('utf-8') for n, outcome in enumerate(GAME_OUTCOMES)]
+
+    def classify():
+        for page in pages:
+            ci.classify_page_state('https://dev.itch.io/game', ci.page_state_from_html(page))
+    yield Case({'outcomes': len(pages)}, classify, number=20)
+
+
+# the mock server
+
+
+@benchmark('get_from_itch_group', requires=('get_from_itch_group', 'Fetcher', 'HttpCache'))
+def bench_get_from_itch_group(context):
+    ci = context.ci
+    url = context.site.collection_url(0)
+    params = {'pages': context.site.collection_pages, 'games_per_page': context.site.games_per_page}
+
+    def get(cache=None):
+        fetcher = context.fetcher(cache)
+        ci.get_from_itch_group(url, fetcher=fetcher)
+        return requests_of(fetcher)
+    yield Case(dict(params, cache='none'), get)
+    # every page is revalidated and answered with 304 Not Modified
+    cache = ci.HttpCache(context.path('cache.db'))
+    get(cache)
+    yield Case(dict(params, cache='revalidated'), lambda: get(cache))
+
+
+@benchmark('get_from_reddit_thread', requires=('get_from_reddit_thread', 'Fetcher'))
+def bench_get_from_reddit_thread(context):
+    ci = context.ci
+    url = context.site.thread_url()
+    params = {'comments': context.site.comments, 'top_comments': context.site.top_comments}
+
+    def get(batch, scan_state=None):
+        fetcher = context.fetcher()
+        ci.get_from_reddit_thread(url, fetcher=fetcher, scan_state=scan_state, batch=batch)
+        return requests_of(fetcher)
+    yield Case(dict(params, batch=True), lambda: get(True))
+    yield Case(dict(params, batch=False), lambda: get(False))
+    # nothing changed since the last scan
+    scan_state = dict()
+    get(True, scan_state)
+    yield Case(dict(params, batch=True, rescan=True), lambda: get(True, dict(scan_state)))
+
+
+@benchmark('discovery', requires=('load_history', 'open_history_store', 'Frontier', 'FRONTIER_DEPTH',
+                                    'crawl_frontier', 'Fetcher'))
+def bench_discovery(context):
+    '''the discovery loop of main() from a reddit thread, a collection and a sale, with a new history'''
+    ci = context.ci
+    state = dict()
+
+    def setup():
+        context.forget_history_stores()
+        name = context.path('history.json')
+        history = ci.load_history(name)
+        store = ci.open_history_store(name)
+        frontier = ci.Frontier(None, ci.FRONTIER_DEPTH)
+        for source in context.site.sources():
+            frontier.add(source, 0, 'source', recheck=True)
+        state.update(history=history, store=store, frontier=frontier, fetcher=context.fetcher())
+
+    def discover():
+        ci.crawl_frontier(state['history'], state['frontier'], state['fetcher'], state['store'], dict(), dict())
+        return dict(requests_of(state['fetcher']), games=len(state['history']['urls']))
+    yield Case({'sources': len(context.site.sources()), 'max_depth': ci.FRONTIER_DEPTH}, discover, setup)
+
+
+@benchmark('preclassify', requires=('preclassify', 'Fetcher'))
+def bench_preclassify(context):
+    ci = context.ci
+    urls = [game_url(n) for n in range(50 * len(GAME_OUTCOMES))]
+
+    def classify():
+        fetcher = context.fetcher()
+        ci.preclassify(urls, fetcher)
+        return requests_of(fetcher)
+    yield Case({'games': len(urls)}, classify)
+
+
+# history
+
+
+def make_history(ci, size):
+    '''a history with `size` game urls, like one of a long time user'''
+    urls = [game_url(n) for n in range(size)]
+    history = {key: [] for key in ci.HISTORY_KEYS}
+    history['urls'] = urls
+    for i, url in enumerate(urls):
+        status = GAME_OUTCOMES[i % len(GAME_OUTCOMES)]
+        if status in history:
+            history[status].append(url)
+    history['checked_groups'] = [MockSite().collection_url(n) for n in range(size // 1000)]
+    return history
+
+
+@benchmark('history', requires=('HISTORY_KEYS', 'load_history', 'save_history'))
+def bench_history(context):
+    ci = context.ci
+    for size in context.sizes:
+        data = make_history(ci, size)
+        state = dict()
+
+        def new_json(data=data):
+            '''a history file from an older version, without a database'''
+            context.forget_history_stores()
+            state['name'] = context.path('history.json')
+            with open(state['name'], 'w') as f:
+                json.dump(data, f)
+
+        def loaded():
+            new_json()
+            state['history'] = ci.load_history(state['name'])
+
+        def saved():
+            loaded()
+            ci.save_history(state['name'], state['history'])
+            context.forget_history_stores()
+
+        def load():
+            ci.load_history(state['name'])
+
+        def save():
+            ci.save_history(state['name'], state['history'])
+
+        yield Case({'urls': size, 'operation': 'import json'}, load, new_json)
+        yield Case({'urls': size, 'operation': 'load'}, load, saved)
+        yield Case({'urls': size, 'operation': 'save'}, save, loaded)
+
+
+@benchmark('show_history', requires=('HISTORY_KEYS', 'load_history', 'save_history'))
+def bench_show_history(context):
+    '''`claim_itch.py --show-history` in a new process, including the start of python and the imports'''
+    ci = context.ci
+    for size in context.sizes:
+        state = dict()
+
+        def saved(size=size):
+            if 'name' in state:
+                return
+            state['name'] = context.path('history.json')
+            with open(state['name'], 'w') as f:
+                json.dump(make_history(ci, size), f)
+            with contextlib.redirect_stdout(io.StringIO()):
+                ci.save_history(state['name'], ci.load_history(state['name']))
+            context.forget_history_stores()
+
+        def show():
+            subprocess.run([sys.executable, ci.__file__, os.path.basename(state['name']), '--show-history'],
+                           cwd=os.path.dirname(state['name']), stdout=subprocess.DEVNULL, check=True)
+
+        yield Case({'urls': size}, show, saved)
+
+
+# running and comparing
+
+
+def load_script(path):
+    spec = importlib.util.spec_from_file_location('claim_itch', path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['claim_itch'] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def measure(case, repeat):
+    '''
+    Run `case` `repeat` times
+    OUTPUT the result of the case, see the module docstring
+    '''
+    runs = []
+    counters = None
+    for _ in range(repeat):
+        if case.setup is not None:
+            case.setup()
+        start = time.perf_counter()
+        for _ in range(case.number):
+            counters = case.run()
+        runs.append((time.perf_counter() - start) / case.number)
+    result = {'params': case.params, 'number': case.number, 'runs': runs,
+              'min': min(runs), 'median': statistics.median(runs), 'mean': statistics.mean(runs)}
+    if isinstance(counters, dict):
+        result['counters'] = counters
+    return result
+
+
+def run_benchmarks(ci, names, repeat, sizes, site):
+    results = []
+    with tempfile.TemporaryDirectory() as temp_dir, MockServer(site) as server:
+        context = Context(ci, server, site, temp_dir, sizes)
+        for name in names:
+            # the benchmarked version doesn't have what the benchmark needs, errors of what it has aren't hidden
+            missing = [attribute for attribute in REQUIRES[name] if not hasattr(ci, attribute)]
+            if missing:
+                results.append({'name': name, 'skipped': f"missing {', '.join(missing)}"})
+                print(f"{name}: skipped, missing {', '.join(missing)}", file=sys.stderr)
+                continue
+            # the output of the benchmarked code is hidden, the progress is printed to stderr
+            try:
+                with contextlib.redirect_stdout(io.StringIO()) as output:
+                    for case in BENCHMARKS[name](context):
+                        output.seek(0)
+                        output.truncate()
+                        result = dict(name=name, **measure(case, repeat))
+                        results.append(result)
+                        print(f"{name} {json.dumps(case.params)}: {format_seconds(result['median'])}", file=sys.stderr)
+            finally:
+                context.forget_history_stores()
+    return results
+
+
+def format_seconds(seconds):
+    if seconds < 1e-3:
+        return f'{seconds * 1e6:.1f}us'
+    if seconds < 1:
+        return f'{seconds * 1e3:.1f}ms'
+    return f'{seconds:.2f}s'
+
+
+def git_commit(path):
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(path), capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old, new, threshold):
+    '''
+    Print how much the median of each benchmark in both results changed
+    OUTPUT the benchmarks that got slower by more than `threshold` (0.1: 10%)
+    '''
+    def key(result):
+        return result['name'], json.dumps(result.get('params'), sort_keys=True)
+
+    old_results = {key(result): result for result in old['results'] if 'median' in result}
+    regressions = []
+    for result in new['results']:
+        old_result = old_results.get(key(result))
+        if old_result is None or 'median' not in result:
+            continue
+        ratio = result['median'] / old_result['median']
+        mark = ''
+        if ratio > 1 + threshold:
+            mark = ' REGRESSION'
+            regressions.append(result)
+        print(f'{result["name"]} {key(result)[1]}: {format_seconds(old_result["median"])} -> '
+              f'{format_seconds(result["median"])} ({ratio:.2f}x){mark}', file=sys.stderr)
+    return regressions
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Benchmark claim_itch.py against a local mock of itch.io and reddit')
+    arg_parser.add_argument('--script', default=DEFAULT_SCRIPT, help=f'claim_itch.py to benchmark (default: {DEFAULT_SCRIPT})')
+    arg_parser.add_argument('--only', help='comma separated names of the benchmarks to run (default: all)')
+    arg_parser.add_argument('--list', action='store_true', help='list the benchmarks and exit')
+    arg_parser.add_argument('--repeat', type=int, default=3, help='runs of each benchmark (default: 3)')
+    arg_parser.add_argument('--sizes', default=','.join(map(str, HISTORY_SIZES)), help=f'comma separated history sizes in urls (default: {",".join(map(str, HISTORY_SIZES))})')
+    arg_parser.add_argument('--comments', type=int, default=MockSite().comments, help=f'comments in the mock reddit thread (default: {MockSite().comments})')
+    arg_parser.add_argument('--output', help='write the results to this json file instead of stdout')
+    arg_parser.add_argument('--compare', help='results of an earlier run (json) to compare with')
+    arg_parser.add_argument('--threshold', type=float, default=0.1, help='slowdown of a median that is reported as a regression (default: 0.1)')
+    args = arg_parser.parse_args()
+
+    if args.list:
+        print('\n'.join(BENCHMARKS))
+        sys.exit(0)
+    names = list(BENCHMARKS) if args.only is None else args.only.split(',')
+    for name in names:
+        if name not in BENCHMARKS:
+            arg_parser.error(f'unknown benchmark {name}, see --list')
+
+    script = os.path.abspath(args.script)
+    ci = load_script(script)
+    site = MockSite(comments=args.comments)
+    sizes = [int(size) for size in args.sizes.split(',')]
+    results = {
+        'meta': {
+            'script': script,
+            'commit': git_commit(script),
+            'time': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'repeat': args.repeat,
+            'site': vars(site),
+        },
+        'results': run_benchmarks(ci, names, args.repeat, sizes, site),
+    }
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    if args.compare is not None:
+        with open(args.compare) as f:
+            old = json.load(f)
+        if compare(old, results, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
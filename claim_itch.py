@@ -4,7 +4,6 @@ ClaimItch/0.12
 requirements:
 - python (tested on 3.8)
 - requests
-- beautiful soup
 - lxml
 - selenium
 - firefox
@@ -12,14 +11,15 @@ requirements:
 
 files and variables:
 - SOURCES variable:   includes itch sales/collections or reddit threads you want check, pass --recheck to retcheck them
+- sources file:       the sources polled with --watch, see load_sources
 - history file:       includes the results of the current run so they can be used in future runs
                       see the HISTORY_KEYS variable
-- log file
+- summary file:       counts of the history for --show-history and --stats, written with the history file
+- log file:           json lines of what changed in each run, see RunLog and --url-log
 
 todo - functionality:
 - better interface for SOURCES
 - seperate always-free download-only games like https://leafxel.itch.io/hojiya
-- when discovering a game connected to a sale, check out the sale
 - games that redirect to a sale
 - notification of new script version
 - download non-claimable games?
@@ -27,19 +27,15 @@ todo - functionality:
 - follow discovered reddit threads?
 
 todo - coding:
-- the steamgifts source is huge, could probably be optimized 'https://itch.io/c/537762/already-claimed-will-be-on-sale-again'
-- handle network errors?
 - debug mode that enables breakpoints
 - log exceptions and urls on error
 - use classes?
 - edge case: non writable config location - would do the work but loss history
-- intersection between SOURCES and discovered collections in has_more?
 - confirm that the keys before & after don't need to be checked in reddit's json
 - proper log
 - proper config
 - claim() return values
 - "selenium.common.exceptions.ElementNotInteractableException: Message: Element <a class="button buy_btn" href=".."> could not be scrolled into view"
-- selenium's performance?
 - less strict parsing / navigation (use .lower) / fuller regex (to work with match and search)
 - pylint
 - a claimable game was recorded as dl_only, was it changed? https://melessthanthree.itch.io/lucah
@@ -48,14 +44,69 @@ todo - coding:
 import os
 import sys
 import re
+import io
 import json
+import gzip
+import glob
+import shutil
 import html
+import sqlite3
+from array import array
 import argparse
-import requests
-from time import sleep, time
-from bs4 import BeautifulSoup
-from selenium import webdriver
-from selenium.common.exceptions import NoSuchElementException
+import queue
+import threading
+import importlib
+import importlib.util
+import contextlib
+import functools
+from time import sleep, time, monotonic
+from urllib.parse import urlsplit, urljoin, quote
+from datetime import datetime, timezone
+
+
+class LazyImport:
+    '''
+    stands in for a module, or an attribute of a module, that is imported the first time it's used
+    the commands that only read the history or the log (--show-history, --stats, --url-log)
+    don't pay for importing selenium, requests and lxml
+      module     e.g. 'lxml', its submodules are imported when they are used, e.g. lxml.html
+      attribute  e.g. a class of `module`, calling the LazyImport calls it
+    exceptions used in `except` have to be real classes, e.g. selenium_exceptions.TimeoutException
+    '''
+    def __init__(self, module, attribute=None):
+        self.module = module
+        self.attribute = attribute
+        self.target = None
+
+    def resolve(self):
+        if self.target is None:
+            target = importlib.import_module(self.module)
+            if self.attribute is not None:
+                target = getattr(target, self.attribute)
+            self.target = target
+        return self.target
+
+    def __getattr__(self, name):
+        target = self.resolve()
+        try:
+            return getattr(target, name)
+        except AttributeError:
+            if self.attribute is not None:
+                raise
+            return importlib.import_module(f'{self.module}.{name}')
+
+    def __call__(self, *args, **kwargs):
+        return self.resolve()(*args, **kwargs)
+
+
+ThreadPoolExecutor = LazyImport('concurrent.futures', 'ThreadPoolExecutor')
+requests = LazyImport('requests')
+lxml = LazyImport('lxml')
+webdriver = LazyImport('selenium.webdriver')
+By = LazyImport('selenium.webdriver.common.by', 'By')
+WebDriverWait = LazyImport('selenium.webdriver.support.ui', 'WebDriverWait')
+EC = LazyImport('selenium.webdriver.support.expected_conditions')
+selenium_exceptions = LazyImport('selenium.common.exceptions')
 
 
 # add any itch sale/collection or reddit thread to this set
@@ -83,13 +134,72 @@ PATTERNS = {
     'itch_sale': r'.+itch\.io/s/.+',
     'itch_group': r'.+itch\.io/[sc]/\d+/.+', # sale or collection
     'reddit_thread': r'.+(?P<thread>reddit\.com/r/.+/comments/.+)/.+',
+    'reddit_thread_id': r'.+/comments/(?P<id>[^/]+)',
     'itch_game': r'(http://|https://)?(?P<game>.+\.itch\.io/[^/?]+)'
 }
 
 
+COMPILED_PATTERNS = {k: re.compile(v) for k, v in PATTERNS.items()}
+
+
+# end of a sale in the script of its page, in UTC, e.g. "end_date":"2020-09-21 07:00:00"
+SALE_END_PATTERN = re.compile(rb'"end_date"\s*:\s*"(?P<date>\d{4}-\d\d-\d\d \d\d:\d\d:\d\d)"')
+
+
 USER_AGENT = 'ClaimItch/0.12'
 
 
+# crawl frontier, see Frontier and --max-depth
+FRONTIER_DEPTH = 3      # links found this many sources away from SOURCES are not followed
+LOW_YIELD_FETCHES = 3   # a sale/collection fetched this many times without new games is not rechecked
+
+
+# default size of the http cache of sale/collection pages and reddit threads, see --cache-size
+CACHE_SIZE = 200 * 2**20 # bytes
+# version of what the extract functions return, cached results of another version are extracted again from the page
+CACHE_FORMAT = 2
+
+
+# seconds before a request without a response fails
+HTTP_TIMEOUT = 30
+HOST_TIMEOUTS = {'old.reddit.com': 60, 'www.reddit.com': 60} # hosts that need a different timeout
+
+
+# network errors, 429 and 5xx responses are retried with exponential backoff, Retry-After is respected
+HTTP_RETRIES = 5
+HTTP_BACKOFF = 2 # seconds, doubles after each retry
+
+
+# brotli responses can only be decoded if a brotli package is installed
+if importlib.util.find_spec('brotli') or importlib.util.find_spec('brotlicffi'):
+    ACCEPT_ENCODING = 'gzip, deflate, br'
+else:
+    ACCEPT_ENCODING = 'gzip, deflate'
+
+
+# collapsed reddit comments are requested in batches from the morechildren endpoint
+# https://www.reddit.com/dev/api#GET_api_morechildren
+REDDIT_API = 'https://www.reddit.com'
+MORE_CHILDREN_LIMIT = 100 # comment ids per request
+
+
+# games owned by the logged in user, paged with ?page=
+LIBRARY_URL = 'https://itch.io/my-purchases'
+# statuses that preclassify() can tell without logging in, a game the user owns looks like the others to anonymous requests
+ANONYMOUS_STATUSES = ('removed', 'claim')
+
+
+# default pacing while getting game links, see --max-requests and --host-rate
+MAX_IN_FLIGHT = 4 # requests running at the same time, across all hosts
+HOST_RATE = 1     # starting requests per second to the same host, it adapts to the responses, see AdaptiveThrottle
+
+
+# AdaptiveThrottle: rates are halved when a server pushes back, and grow by a quarter after a streak of healthy responses
+RATE_BOUNDS = (1/30, 5) # minimum and maximum rate, as a multiple of the starting rate
+HEALTHY_STREAK = 20     # healthy responses before the rate grows
+SLOW_RESPONSE = 10      # seconds, slower responses count as pushback
+
+
 HISTORY_KEYS = [
     'urls',           # discovered game urls
     'claimed',        # claimed games
@@ -106,7 +216,110 @@ HISTORY_KEYS = [
     'old_error',      # games that broke the script but were fixed later
 ]
 
+# seconds to wait for elements that are loaded after a click
+WAIT_TIMEOUT = 10
+
+
+# firefox preferences that cut what the browser downloads and renders, claim() only needs the html, see --no-blocking
+# firefox can't block any third-party script without an extension, tracking protection blocks the analytics ones
+# reCAPTCHA is not blocked, but it can only be solved with --enable-images and --no-blocking
+BLOCKING_PREFERENCES = {
+    'permissions.default.stylesheet': 2,
+    'browser.display.use_document_fonts': 0,
+    'gfx.downloadable_fonts.enabled': False,
+    'media.autoplay.default': 5, # block audio and video
+    'media.autoplay.blocking_policy': 2,
+    'privacy.trackingprotection.enabled': True,
+    'privacy.trackingprotection.socialtracking.enabled': True,
+    'privacy.trackingprotection.cryptomining.enabled': True,
+    'privacy.trackingprotection.fingerprinting.enabled': True,
+    'network.prefetch-next': False,
+    'network.dns.disablePrefetch': True,
+}
+
+
+# a game leased from the work queue goes back to the queue if its result isn't recorded in time, see WorkQueue
+LEASE_SECONDS = 600
+
+
+# watch mode, see --watch
+POLL_INTERVAL = 600      # seconds between polls of a source that has no interval in the sources file
+SOURCES_FILE_CHECK = 60  # seconds between checks of the sources file for changes
+STATUS_PORT = 8765       # the status is served on http://localhost:STATUS_PORT/status, see serve_status
+
+
+# default pacing while claiming games, see --workers, --view-rate and --claim-rate
+# both rates are starting rates across all browsers, they adapt to itch, see AdaptiveThrottle
+CLAIM_WORKERS = 1   # browsers claiming games at the same time
+VIEW_RATE = 1       # game pages visited per second
+CLAIM_RATE = 1/5    # games claimed per second
+THROTTLE_BACKOFF = (60, 900) # seconds all browsers pause after itch throttles, doubles up to the maximum
+THROTTLE_RETRIES = 3 # times a throttled game is retried before it's recorded as an error
+
+
+# detects pages that itch shows instead of the game when it's throttling us
+THROTTLE_SCRIPT = '''
+var text = document.body === null ? '' : document.body.textContent.toLowerCase();
+return text.indexOf('too many requests') >= 0 ||
+       document.querySelector('iframe[src*="recaptcha"], div.g-recaptcha') !== null;
+'''
+
+
+# probes all the elements that claim() needs to classify a game page in one call
+PAGE_STATE_SCRIPT = '''
+function text(selector) {
+    var element = document.querySelector(selector);
+    return element === null ? null : element.textContent;
+}
+var buy = text('div.buy_row a.buy_btn');
+if (buy === null) {
+    buy = text('section.game_download a.buy_btn');
+}
+return {
+    'not_found': document.querySelector('div.not_found_game_page') !== null,
+    'owned': text('div.purchase_banner_inner h2'),
+    'buy': buy,
+    'sale_rate': text('.sale_rate'),
+    'uploads': document.querySelector('div.uploads') !== null,
+    'web': document.querySelector('div.html_embed_widget') !== null,
+};
+'''
+
+
+# metrics of each run, see Metrics
+# upper bounds in seconds of the buckets of the timers
+HISTOGRAM_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+METRIC_HELP = {
+    'phase_seconds': 'Time of each phase of the run',
+    'http_request_seconds': 'Time of http requests, including retries',
+    'http_bytes': 'Bytes of http responses',
+    'http_cache': 'Lookups in the http cache by result',
+    'parse_seconds': 'Time spent parsing pages and json',
+    'history_seconds': 'Time spent loading and saving the history',
+    'browser_seconds': 'Time of browser steps: page loads, scripts and waits for elements',
+    'claim_seconds': 'Time to handle a game by outcome and method',
+    'sleep_seconds': 'Time spent sleeping on purpose, by reason',
+    'rate_changes': 'Changes of the adaptive request rates',
+    'watch_polls': 'Polls of the sources in --watch mode by outcome',
+}
+# the run log, see RunLog and --url-log
+LOG_BUFFER = 200            # records kept in memory before they are written
+LOG_FLUSH_SECONDS = 5       # buffered records are written at least this often
+LOG_MAX_BYTES = 10 * 2**20  # the log is compressed and a new one is started when it's bigger than this
+LOG_MAX_AGE = 7 * 24 * 3600 # seconds, or when its first record is older than this
+LOG_SEGMENTS = 10           # compressed logs that are kept, the older ones are deleted
+# phases that can be profiled with --profile
+PROFILE_PHASES = ('discovery', 'preclassify', 'login', 'library', 'claim')
+
+
 PROCESSED_GAMES = ('claimed', 'dl_only', 'dl_only_old', 'downloaded', 'buy', 'removed', 'web', 'always_free')
+# status bits of a game in GameIndex, one for each of PROCESSED_GAMES
+STATUS_BITS = {status: 1 << i for i, status in enumerate(PROCESSED_GAMES)}
+# flags of a game in GameIndex, for the other history keys it keeps
+FLAG_DISCOVERED = 1 # in 'urls'
+FLAG_HAS_MORE = 2   # in 'has_more', only games, sales and collections aren't in the index
+FLAG_ERROR = 4      # in 'error'
+INDEX_FLAGS = {'urls': FLAG_DISCOVERED, 'has_more': FLAG_HAS_MORE, 'error': FLAG_ERROR}
 
 
 class ParsingError(Exception):
@@ -116,122 +329,1221 @@ class ParsingError(Exception):
         super().__init__(url, *args, **kwargs)
 
 
+class Throttled(ParsingError):
+    '''itch refused a request because there were too many'''
+
+
+class LeaseLost(Exception):
+    '''the lease of a game from the WorkQueue expired, another worker may be claiming it'''
+
+
+class ClaimStopped(Exception):
+    '''the claim of a game was stopped before it started, e.g. on Ctrl+C'''
+
+
+class Metrics:
+    '''
+    timers and counters of a run, shared between threads, written to json and prometheus text files by write()
+    timers are histograms (see HISTOGRAM_BUCKETS), both have labels like the host or the outcome of a claim
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = dict() # (name, labels): [count of each bucket and of +Inf, count, sum]
+        self.counters = dict()   # (name, labels): value
+        self.profile = None      # (phase, file) profiled by phase(), see --profile
+
+    def count(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        global HISTOGRAM_BUCKETS
+
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.setdefault(key, [0] * (len(HISTOGRAM_BUCKETS) + 1) + [0, 0])
+            for i, bound in enumerate(HISTOGRAM_BUCKETS):
+                if seconds <= bound:
+                    histogram[i] += 1
+                    break
+            else:
+                # slower than the last bucket
+                histogram[len(HISTOGRAM_BUCKETS)] += 1
+            histogram[-2] += 1
+            histogram[-1] += seconds
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        '''
+        Time the block, the labels can be changed in the block, e.g. to set the outcome
+        if the block raises an exception, the label 'outcome' (if there is one) is its type
+        '''
+        start = monotonic()
+        try:
+            yield labels
+        except Exception as e:
+            if 'outcome' in labels:
+                labels['outcome'] = type(e).__name__
+            raise
+        finally:
+            self.observe(name, monotonic() - start, **labels)
+
+    def timed(self, name, **labels):
+        '''Decorator that times each call of a function, labeled with the function's name'''
+        def decorator(function):
+            @functools.wraps(function)
+            def timed_function(*args, **kwargs):
+                with self.timer(name, function=function.__name__, **labels):
+                    return function(*args, **kwargs)
+            return timed_function
+        return decorator
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        '''
+        Time a phase of the run, it's profiled with cProfile if it's the phase in `profile`
+        threads started during the phase are profiled too
+        '''
+        if self.profile is None or self.profile[0] != name:
+            with self.timer('phase_seconds', phase=name):
+                yield
+            return
+
+        import cProfile
+        import pstats
+
+        profilers = []
+
+        def profile_thread(*args):
+            # called once in each new thread, the profiler replaces it
+            profiler = cProfile.Profile()
+            profilers.append(profiler)
+            profiler.enable()
+
+        main_profiler = cProfile.Profile()
+        profilers.append(main_profiler)
+        threading.setprofile(profile_thread)
+        main_profiler.enable()
+        try:
+            with self.timer('phase_seconds', phase=name):
+                yield
+        finally:
+            main_profiler.disable()
+            threading.setprofile(None)
+            stats = pstats.Stats(*profilers)
+            stats.dump_stats(self.profile[1])
+            print(f'profile of {name} written to {self.profile[1]}, the slowest functions:')
+            stats.sort_stats('cumulative').print_stats(15)
+
+    def phase_seconds(self):
+        '''a dict of phase: seconds'''
+        return {dict(labels)['phase']: histogram[-1] for (name, labels), histogram in self.histograms.items()
+                if name == 'phase_seconds'}
+
+    def to_json(self):
+        global HISTOGRAM_BUCKETS
+
+        with self.lock:
+            histograms = [{'name': name, 'labels': dict(labels), 'count': histogram[-2], 'sum': histogram[-1],
+                           'buckets': dict(zip(map(str, HISTOGRAM_BUCKETS + ('+Inf',)), histogram))}
+                          for (name, labels), histogram in sorted(self.histograms.items())]
+            counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                        for (name, labels), value in sorted(self.counters.items())]
+        return {'histograms': histograms, 'counters': counters}
+
+    def to_prometheus(self, prefix='claim_itch_'):
+        '''The metrics in prometheus text exposition format, e.g. for the textfile collector of node_exporter'''
+        global HISTOGRAM_BUCKETS, METRIC_HELP
+
+        def format_labels(labels):
+            if not labels:
+                return ''
+            escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in labels) + '}'
+
+        lines = []
+        with self.lock:
+            for metrics, kind in ((self.histograms, 'histogram'), (self.counters, 'counter')):
+                for name in sorted(set(name for name, labels in metrics)):
+                    full_name = prefix + name + ('_total' if kind == 'counter' else '')
+                    lines.append(f'# HELP {full_name} {METRIC_HELP.get(name, name)}')
+                    lines.append(f'# TYPE {full_name} {kind}')
+                    for (metric, labels), value in sorted(metrics.items()):
+                        if metric != name:
+                            continue
+                        if kind == 'counter':
+                            lines.append(f'{full_name}{format_labels(labels)} {value}')
+                            continue
+                        cumulative = 0
+                        for bound, count in zip(HISTOGRAM_BUCKETS + ('+Inf',), value[:-2]):
+                            cumulative += count
+                            lines.append(f'{full_name}_bucket{format_labels(labels + (("le", bound),))} {cumulative}')
+                        lines.append(f'{full_name}_count{format_labels(labels)} {value[-2]}')
+                        lines.append(f'{full_name}_sum{format_labels(labels)} {value[-1]}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, name, run_time):
+        '''Write the metrics to name.json and name.prom, returns the file names'''
+        files = []
+        for extension, content in (('.json', lambda: json.dumps(dict(self.to_json(), run=run_time), indent=2)),
+                                   ('.prom', self.to_prometheus)):
+            temp_name = name + extension + '.tmp'
+            with open(temp_name, 'w') as f:
+                f.write(content())
+            os.replace(temp_name, name + extension)
+            files.append(name + extension)
+        return files
+
+
+METRICS = Metrics()
+
+
+class RunLog:
+    '''
+    json-lines log of what changed: discovered games, status changes, errors with the url that caused them, ..
+    each record has the time, the run and the event, records are buffered and written by flush()
+    the log is rotated by size or age, see LOG_MAX_BYTES and LOG_MAX_AGE, old segments are compressed
+    nothing is written until open() is called, see query_log to read it
+    '''
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.path = None
+        self.run = None
+        self.buffer = []
+        self.flushed = monotonic()
+        self.started = None # time of the first record in the log file
+
+    def open(self, path, run):
+        '''Log to `path`, records are labeled with `run`'''
+        global LOG_MAX_AGE
+
+        with self.lock:
+            self.path = path
+            self.run = run
+            self.started = None
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    self.started = json.loads(f.readline())['time']
+            except (OSError, ValueError, KeyError):
+                pass
+            if self.started is not None and time() - self.started >= LOG_MAX_AGE:
+                self.rotate()
+
+    def write(self, event, **fields):
+        '''Record an event, sets in `fields` are written as sorted lists'''
+        global LOG_BUFFER, LOG_FLUSH_SECONDS
+
+        if self.path is None:
+            return
+        record = dict(time=round(time(), 3), run=self.run, event=event, **fields)
+        line = json.dumps(record, default=lambda value: sorted(value) if isinstance(value, (set, frozenset)) else repr(value))
+        with self.lock:
+            self.buffer.append(line)
+            if len(self.buffer) >= LOG_BUFFER or monotonic() - self.flushed >= LOG_FLUSH_SECONDS:
+                self.flush()
+
+    def flush(self):
+        global LOG_MAX_BYTES, LOG_MAX_AGE
+
+        with self.lock:
+            self.flushed = monotonic()
+            if self.path is None or len(self.buffer) == 0:
+                return
+            if self.started is None:
+                self.started = json.loads(self.buffer[0])['time']
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write('\n'.join(self.buffer) + '\n')
+            self.buffer = []
+            if os.path.getsize(self.path) >= LOG_MAX_BYTES or time() - self.started >= LOG_MAX_AGE:
+                self.rotate()
+
+    def rotate(self):
+        '''Compress the log to path.TIME.gz and start a new one, only LOG_SEGMENTS compressed logs are kept'''
+        global LOG_SEGMENTS
+
+        with self.lock:
+            segment = f'{self.path}.{datetime.now():%Y%m%d-%H%M%S-%f}.gz'
+            temp_name = self.path + '.rotating'
+            os.replace(self.path, temp_name)
+            with open(temp_name, 'rb') as f, gzip.open(segment, 'wb') as compressed:
+                shutil.copyfileobj(f, compressed)
+            os.remove(temp_name)
+            self.started = None
+            for old_segment in sorted(glob.glob(glob.escape(self.path) + '.*.gz'))[:-LOG_SEGMENTS]:
+                os.remove(old_segment)
+
+
+def log_segments(path):
+    '''The compressed segments of the run log `path`, oldest first, followed by `path` if it exists'''
+    segments = sorted(glob.glob(glob.escape(path) + '.*.gz'))
+    if os.path.exists(path):
+        segments.append(path)
+    return segments
+
+
+def query_log(path, url):
+    '''
+    INPUTS
+      path  a run log, see RunLog, its compressed segments are read too
+      url   a game, sale, collection or reddit thread
+    OUTPUT
+      the records about `url`, oldest first
+    '''
+    # most lines are skipped without parsing them
+    quoted = json.dumps(url)
+    for segment in log_segments(path):
+        opener = gzip.open if segment.endswith('.gz') else open
+        with opener(segment, 'rt', encoding='utf-8') as f:
+            for line in f:
+                if quoted not in line:
+                    continue
+                record = json.loads(line)
+                if url in (record.get('url'), record.get('source')) or url in record.get('urls', ()):
+                    yield record
+
+
+RUN_LOG = RunLog()
+
+
+def host_label(url):
+    '''Host of `url` for the rate limits and the metrics, all game pages are *.itch.io and share them'''
+    host = urlsplit(url).netloc
+    return '*.itch.io' if host.endswith('.itch.io') else host
+
+
+class HostRateLimiter:
+    '''
+    token bucket for each host, shared between threads, the hosts of all game pages share one, see host_label
+      rate   requests per second allowed for each host (None: no limit)
+      burst  requests that can be made at once before the rate applies
+    '''
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = dict() # host: (tokens, time of last update)
+        self.lock = threading.Lock()
+
+    def wait(self, url):
+        '''Block until a request to the host of `url` is allowed'''
+        self.take(host_label(url))
+
+    def rate_for(self, key):
+        return self.rate
+
+    def take(self, key, stop=None):
+        '''
+        Block until a token for `key` is available, any string can be used as a key
+        `stop` (a threading.Event) ends the wait when it's set, e.g. on Ctrl+C, no token is taken then
+        OUTPUT True if a token was taken, False if `stop` was set
+        '''
+        while True:
+            with self.lock:
+                rate = self.rate_for(key)
+                if rate is None:
+                    return True
+                now = monotonic()
+                tokens, last = self.buckets.get(key, (self.burst, now))
+                tokens = min(self.burst, tokens + (now - last) * rate)
+                if tokens >= 1:
+                    self.buckets[key] = (tokens - 1, now)
+                    return True
+                self.buckets[key] = (tokens, now)
+                delay = (1 - tokens) / rate
+            with METRICS.timer('sleep_seconds', reason='rate limit'):
+                if stop is None:
+                    sleep(delay)
+                elif stop.wait(delay):
+                    return False
+
+
+class AdaptiveThrottle(HostRateLimiter):
+    '''
+    token bucket for each key whose rate follows what the server tolerates
+    the rate of a key is halved when the server pushes back (429, captcha, errors, slow responses)
+    and grows by a quarter after HEALTHY_STREAK healthy responses in a row, within RATE_BOUNDS
+      name      shown with each rate change
+      rate      starting rate per second for each key (None: no limit)
+    rate changes are logged to RUN_LOG
+    '''
+    def __init__(self, name, rate):
+        global RATE_BOUNDS
+
+        super().__init__(rate)
+        self.name = name
+        self.rates = dict()   # key: current rate
+        self.streaks = dict() # key: healthy responses in a row
+        if rate is not None:
+            self.min_rate, self.max_rate = (rate * bound for bound in RATE_BOUNDS)
+
+    def rate_for(self, key):
+        return self.rates.get(key, self.rate)
+
+    def healthy(self, key):
+        global HEALTHY_STREAK
+
+        if self.rate is None:
+            return
+        with self.lock:
+            self.streaks[key] = self.streaks.get(key, 0) + 1
+            if self.streaks[key] < HEALTHY_STREAK or self.rate_for(key) >= self.max_rate:
+                return
+            self.streaks[key] = 0
+            self.change(key, min(self.max_rate, self.rate_for(key) * 1.25), f'{HEALTHY_STREAK} healthy responses')
+
+    def pushback(self, key, reason):
+        if self.rate is None:
+            return
+        with self.lock:
+            self.streaks[key] = 0
+            if self.rate_for(key) > self.min_rate:
+                self.change(key, max(self.min_rate, self.rate_for(key) / 2), reason)
+
+    def change(self, key, rate, reason):
+        METRICS.count('rate_changes', throttle=self.name, direction='up' if rate > self.rate_for(key) else 'down')
+        self.rates[key] = rate
+        print(f' {self.name} rate for {key}: {rate:.3f}/s ({reason})')
+        RUN_LOG.write('rate', throttle=self.name, key=key, rate=rate, reason=reason)
+
+
+class CachedResponse:
+    '''stands in for a requests response when the page is served from HttpCache'''
+    status_code = 200
+
+    def __init__(self, url, content):
+        self.url = url
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', 'replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class HttpCache:
+    '''
+    on-disk cache of pages and of what was extracted from them, pages are revalidated with ETag / Last-Modified
+      path      sqlite database
+      max_size  bytes of pages to keep, the least recently used pages are removed first
+      ttl       seconds a page is used without asking the server if it changed (0: always ask)
+    '''
+    def __init__(self, path, max_size=CACHE_SIZE, ttl=0):
+        self.path = path
+        self.max_size = max_size
+        self.ttl = ttl
+        self.stats = {'fresh': 0, 'not modified': 0, 'miss': 0}
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS pages (
+            key TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, stored REAL, accessed REAL,
+            size INTEGER, body BLOB, extracted TEXT)''')
+        # bytes of pages in the cache, kept up to date by store and evict so the table isn't summed on every store
+        self.total, = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM pages').fetchone()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        '''the writes of a store in one transaction, in autocommit mode each statement would be its own'''
+        with self.lock:
+            self.connection.execute('BEGIN')
+            try:
+                yield self.connection
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+            self.connection.execute('COMMIT')
+
+    def lookup(self, key):
+        '''
+        OUTPUT the cached page or None, its 'extracted' is {'result': what was extracted from it}
+               or None if nothing was extracted from it with this CACHE_FORMAT
+        '''
+        global CACHE_FORMAT
+
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT etag, last_modified, stored, body, extracted FROM pages WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        entry = dict(zip(('etag', 'last_modified', 'stored', 'body', 'extracted'), row))
+        extracted = json.loads(entry['extracted']) if entry['extracted'] is not None else None
+        if not isinstance(extracted, dict) or extracted.get('format') != CACHE_FORMAT:
+            extracted = None
+        entry['extracted'] = extracted
+        return entry
+
+    def is_fresh(self, entry):
+        return self.ttl > 0 and time() - entry['stored'] < self.ttl
+
+    def count(self, stat):
+        METRICS.count('http_cache', result=stat)
+        with self.lock:
+            self.stats[stat] += 1
+
+    def touch(self, key, revalidated=False):
+        with self.lock:
+            if revalidated:
+                self.connection.execute('UPDATE pages SET accessed = ?, stored = ? WHERE key = ?', (time(), time(), key))
+            else:
+                self.connection.execute('UPDATE pages SET accessed = ? WHERE key = ?', (time(), key))
+
+    def store(self, key, res, extracted):
+        '''Store a response, or only `extracted` if `res` is a CachedResponse'''
+        global CACHE_FORMAT
+
+        extracted = json.dumps({'format': CACHE_FORMAT, 'result': extracted}, default=sorted)
+        if isinstance(res, CachedResponse):
+            with self.lock:
+                self.connection.execute('UPDATE pages SET extracted = ?, accessed = ? WHERE key = ?', (extracted, time(), key))
+            return
+        with self.transaction() as connection:
+            old = connection.execute('SELECT size FROM pages WHERE key = ?', (key,)).fetchone()
+            connection.execute('INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                               (key, res.headers.get('ETag'), res.headers.get('Last-Modified'), time(), time(),
+                                len(res.content), res.content, extracted))
+            total = self.total + len(res.content) - (old[0] if old else 0)
+            self.total = self.evict(total)
+
+    def evict(self, total):
+        '''
+        Remove the least recently used pages until the cache fits in max_size, in the transaction of store
+        INPUT  bytes of pages in the cache
+        OUTPUT bytes of pages left
+        '''
+        if total <= self.max_size:
+            return total
+        for key, size in self.connection.execute('SELECT key, size FROM pages ORDER BY accessed').fetchall():
+            self.connection.execute('DELETE FROM pages WHERE key = ?', (key,))
+            total -= size
+            if total <= self.max_size:
+                break
+        return total
+
+
+def create_session(pool_size=MAX_IN_FLIGHT):
+    '''
+    A requests session that keeps up to `pool_size` connections alive per host, accepts compressed responses,
+    and retries GET requests, see HTTP_RETRIES
+    '''
+    global USER_AGENT, ACCEPT_ENCODING, HTTP_RETRIES, HTTP_BACKOFF
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    retry = Retry(total=HTTP_RETRIES, backoff_factor=HTTP_BACKOFF, status_forcelist=(429, 500, 502, 503, 504),
+                  allowed_methods=frozenset(['GET', 'HEAD']), respect_retry_after_header=True, raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers['User-Agent'] = USER_AGENT
+    session.headers['Accept-Encoding'] = ACCEPT_ENCODING
+    return session
+
+
+def timeout_for(url):
+    '''Seconds before a request to `url` without a response fails'''
+    global HTTP_TIMEOUT, HOST_TIMEOUTS
+
+    return HOST_TIMEOUTS.get(urlsplit(url).netloc, HTTP_TIMEOUT)
+
+
+class Fetcher:
+    '''
+    gets pages for all sources, requests to the same host are paced by a single AdaptiveThrottle
+    and share pooled keep-alive connections, see create_session
+      max_in_flight  maximum number of requests running at the same time
+      host_rate      starting requests per second for each host (None: no limit)
+      cache          an HttpCache used by get_extracted()
+    '''
+    def __init__(self, max_in_flight=MAX_IN_FLIGHT, host_rate=HOST_RATE, cache=None):
+        self.max_in_flight = max_in_flight
+        self.limiter = AdaptiveThrottle('http', host_rate)
+        self.in_flight = threading.BoundedSemaphore(max_in_flight)
+        self.cache = cache
+        self.session = create_session(max_in_flight)
+        self.stats = dict() # host: {'requests', 'bytes', 'seconds', 'max seconds'}
+        self.stats_lock = threading.Lock()
+
+    def get(self, url, session=None, **kwargs):
+        '''like requests.get, uses `session` instead of the shared session if given'''
+        global SLOW_RESPONSE
+
+        kwargs.setdefault('timeout', timeout_for(url))
+        host = host_label(url)
+        self.limiter.wait(url)
+        with self.in_flight:
+            start = monotonic()
+            try:
+                res = (session or self.session).get(url, **kwargs)
+            except requests.RequestException as re_e:
+                self.limiter.pushback(host, type(re_e).__name__)
+                raise
+            seconds = monotonic() - start
+            self.record(url, seconds, len(res.content))
+        METRICS.observe('http_request_seconds', seconds, host=host)
+        METRICS.count('http_bytes', len(res.content), host=host)
+        # responses retried by the session are in its retry history
+        retries = getattr(res.raw, 'retries', None)
+        statuses = [res.status_code] + [retry.status for retry in (retries.history if retries else ())]
+        if 429 in statuses:
+            self.limiter.pushback(host, '429 too many requests')
+        elif any(status is not None and status >= 500 for status in statuses):
+            self.limiter.pushback(host, 'server error')
+        elif seconds > SLOW_RESPONSE:
+            self.limiter.pushback(host, f'slow response {seconds:.1f}s')
+        else:
+            self.limiter.healthy(host)
+        return res
+
+    def record(self, url, seconds, size):
+        host = host_label(url)
+        with self.stats_lock:
+            stats = self.stats.setdefault(host, {'requests': 0, 'bytes': 0, 'seconds': 0, 'max seconds': 0})
+            stats['requests'] += 1
+            stats['bytes'] += size
+            stats['seconds'] += seconds
+            stats['max seconds'] = max(stats['max seconds'], seconds)
+
+    def get_extracted(self, url, extract, params=None, headers=None):
+        '''
+        INPUTS
+          url      page to get
+          extract  function of a response that returns what's needed from the page, it should be json serializable
+        OUTPUT
+          response, extract(response) or None if the response isn't 200
+        when the page didn't change since it was cached, the last result of `extract` is reused
+        '''
+        if self.cache is None:
+            res = self.get(url, params=params, headers=headers)
+            return res, (extract(res) if res.status_code == 200 else None)
+
+        key = requests.Request('GET', url, params=params).prepare().url
+        entry = self.cache.lookup(key)
+        if entry is not None and self.cache.is_fresh(entry):
+            self.cache.count('fresh')
+            self.cache.touch(key)
+            res = CachedResponse(key, entry['body'])
+        else:
+            headers = dict(headers or {})
+            if entry is not None and entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry is not None and entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+            res = self.get(key, headers=headers)
+            if res.status_code == 304 and entry is not None:
+                self.cache.count('not modified')
+                self.cache.touch(key, revalidated=True)
+                res = CachedResponse(key, entry['body'])
+            else:
+                self.cache.count('miss')
+                entry = None
+        if entry is not None and entry['extracted'] is not None:
+            return res, entry['extracted']['result']
+        if res.status_code != 200:
+            return res, None
+        result = extract(res)
+        self.cache.store(key, res, result)
+        return res, result
+
+
+def has_class(element, name):
+    return name in element.get('class', '').split()
+
+
+@METRICS.timed('parse_seconds')
 def extract_from_itch_group(group_page):
     '''
     INPUT  html sale or collection page
     OUTPUT urls of all games, urls of games that avie noted is connected to more sales
+    the page is parsed in one streaming pass, elements are freed as soon as they were checked
     '''
-    soup = BeautifulSoup(group_page, 'lxml')
-    ended = soup.find_all('div', class_ = 'not_active_notification')
+    if isinstance(group_page, str):
+        group_page = group_page.encode('utf-8')
     urls, more = set(), set()
-    if ended:
-        print(" Sale ended")
-        return urls, more
-    games = soup.find_all('div', class_='game_cell')
-    for game in games:
-        url = game.find('a').get('href')
-        urls.add(url)
-        if game.find('div', class_='blurb_outer') is not None:
-            more.add(url)
+    cell = None # the game_cell div being parsed
+    url, is_more = None, False
+    for event, element in lxml.etree.iterparse(io.BytesIO(group_page), events=('start', 'end'), html=True, recover=True):
+        if not isinstance(element.tag, str): # comments and processing instructions
+            continue
+        if event == 'start':
+            if element.tag == 'div' and has_class(element, 'not_active_notification'):
+                print(" Sale ended")
+                return set(), set()
+            if cell is None:
+                if element.tag == 'div' and has_class(element, 'game_cell'):
+                    cell, url, is_more = element, None, False
+            elif element.tag == 'a' and url is None:
+                url = element.get('href')
+            elif element.tag == 'div' and has_class(element, 'blurb_outer'):
+                is_more = True
+        elif element is cell:
+            urls.add(url)
+            if is_more:
+                more.add(url)
+            cell = None
+        if event == 'end' and cell is None:
+            # free parsed elements
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
     return urls, more
 
 
-def get_from_itch_group(group_url, sleep_time=15, max_page=None, sale=False):
+@METRICS.timed('parse_seconds')
+def extract_sale_end(sale_page):
+    '''
+    INPUT  html sale page
+    OUTPUT unix time when the sale ends, None if it's not in the page
+    '''
+    global SALE_END_PATTERN
+
+    if isinstance(sale_page, str):
+        sale_page = sale_page.encode('utf-8')
+    match = SALE_END_PATTERN.search(sale_page)
+    if match is None:
+        return None
+    end = datetime.strptime(match['date'].decode(), '%Y-%m-%d %H:%M:%S')
+    return end.replace(tzinfo=timezone.utc).timestamp()
+
+
+def get_from_itch_group(group_url, max_page=None, sale=False, fetcher=None, sale_info=None):
     '''
     INPUT  itch.io collection url
     OUTPUT see extract_urls
+    pages are requested `fetcher.max_in_flight` at a time, the results are merged in page order
+    for sales, sale_info (a dict) gets 'end': unix time when the sale ends, or None
     '''
+    if fetcher is None:
+        fetcher = Fetcher()
     if sale:
         max_page = 1 # sales don't seem to have pages
     page = 1
     urls = set()
     has_more = set()
-    while max_page is None or page <= max_page:
-        print(f' getting page {page}')
+
+    def get_page(page):
+        print(f' getting page {page} of {group_url}')
         params = {'page': page} if not sale else None
-        res = requests.get(group_url, params=params)
+        if sale:
+            extract = lambda res: (*extract_from_itch_group(res.content), extract_sale_end(res.content))
+        else:
+            extract = lambda res: extract_from_itch_group(res.content)
+        res, result = fetcher.get_extracted(group_url, extract, params=params)
         if res.status_code == 404:
-            break
+            return None
         elif res.status_code != 200:
             # breakpoint()
             res.raise_for_status()
-        page += 1
-        new_urls, new_more = extract_from_itch_group(res.text)
-        urls.update(new_urls)
-        has_more.update(new_more)
-        print(f' sleeping for {sleep_time}s')
-        sleep(sleep_time)
-    print(f' got {len(urls)} games')
+        return result
+
+    with ThreadPoolExecutor(fetcher.max_in_flight) as executor:
+        while max_page is None or page <= max_page:
+            last_page = page + fetcher.max_in_flight - 1
+            if max_page is not None:
+                last_page = min(last_page, max_page)
+            pages = range(page, last_page + 1)
+            done = False
+            for result in executor.map(get_page, pages):
+                if result is None:
+                    done = True
+                    break
+                new_urls, new_more, *end = result
+                urls.update(new_urls)
+                has_more.update(new_more)
+                if sale and sale_info is not None:
+                    sale_info['end'] = end[0]
+            if done:
+                break
+            page = last_page + 1
+    print(f' got {len(urls)} games from {group_url}')
     return urls, has_more
 
 
-def get_from_reddit_thread(url, sleep_time=15):
+@METRICS.timed('parse_seconds')
+def extract_links(fragments):
     '''
-    INPUT  reddit thread url
-    OUTPUT itch.io game urls, itch.io groups (sales, collections)
+    INPUT  html fragments, e.g. the bodies of reddit comments
+    OUTPUT itch.io game urls, itch.io groups (sales, collections) linked in the fragments
+    all fragments are parsed together as one document
     '''
-    global USER_AGENT, PATTERNS
+    global COMPILED_PATTERNS
+
+    fragments = [fragment for fragment in fragments if fragment]
+    if not fragments:
+        return set(), set()
+    document = lxml.html.document_fromstring(''.join(f'<div>{fragment}</div>' for fragment in fragments))
+    links = set(document.xpath('//a/@href'))
+    urls = set(filter(COMPILED_PATTERNS['itch_game'].match, links))
+    groups = set(filter(COMPILED_PATTERNS['itch_group'].match, links))
+    return urls, groups
+
+
+@METRICS.timed('parse_seconds')
+def extract_from_reddit_listing(data, json_url):
+    '''
+    INPUTS
+      data      reddit comments json
+      json_url  where `data` is from
+    OUTPUT
+      itch.io game urls, itch.io groups (sales, collections), ids of collapsed comments (more),
+      ids of the comments in `data`, time of the newest comment
+    '''
+    texts, chains, comments, newest = [], [], [], 0
+    for listing in data:
+        if listing['kind'].lower() != 'listing':
+            raise ParsingError(json_url)
+        children = listing['data']['children']
+        for child in children:
+            text = None
+            if child['kind'] == 't3':
+                text = child['data']['selftext_html']
+            elif child['kind'] == 't1':
+                text = child['data']['body_html']
+                comments.append(child['data']['id'])
+                newest = max(newest, child['data'].get('created_utc', 0))
+            elif child['kind'] == 'more':
+                chains.extend(child['data']['children'])
+            else:
+                raise ParsingError(json_url)
+            if text is not None and len(text) > 0:
+                texts.append(html.unescape(text))
+    urls, has_more = extract_links(texts)
+    return urls, has_more, chains, comments, newest
+
+
+def extract_from_more_children(data, json_url):
+    '''
+    INPUTS
+      data      json returned by reddit's morechildren endpoint, a flat list of comments
+      json_url  where `data` is from
+    OUTPUT
+      see extract_from_reddit_listing
+    '''
+    try:
+        if data['json'].get('errors'):
+            raise ParsingError(json_url)
+        things = data['json']['data']['things']
+    except (KeyError, TypeError) as e:
+        raise ParsingError(json_url) from e
+    return extract_from_reddit_listing([{'kind': 'Listing', 'data': {'children': things}}], json_url)
+
+
+def get_from_reddit_thread(url, fetcher=None, scan_state=None, batch=True):
+    '''
+    INPUTS
+      url         reddit thread url
+      scan_state  a dict describing the last scan of the thread, updated when the thread was scanned
+                  if it's not empty, only comments added since that scan are requested
+      batch       request collapsed comments MORE_CHILDREN_LIMIT at a time from REDDIT_API,
+                  instead of one comment chain per request
+    OUTPUT
+      itch.io game urls, itch.io groups (sales, collections)
+    comment chains found in the same round are requested in parallel
+    '''
+    global USER_AGENT, COMPILED_PATTERNS, REDDIT_API, MORE_CHILDREN_LIMIT
 
     # https://www.reddit.com/dev/api#GET_comments_{article}
     # https://github.com/reddit-archive/reddit/wiki/JSON
-    base_url = f"https://{re.match(PATTERNS['reddit_thread'], url)['thread']}" # does not end with /
+    base_url = f"https://{COMPILED_PATTERNS['reddit_thread'].match(url)['thread']}" # does not end with /
+    if fetcher is None:
+        fetcher = Fetcher()
+    if scan_state is None:
+        scan_state = dict()
+    incremental = len(scan_state) > 0
+    seen = set(scan_state.get('seen', []))         # ids of comments that were scanned
+    expanded = set(scan_state.get('expanded', [])) # ids of collapsed comments that were requested
+    newest = scan_state.get('newest', 0)           # created_utc of the newest comment
+    known_newest = newest
     urls = set()
     has_more = set()
 
-    chains = ['']
-    while len(chains) > 0:
-        current_chain = chains.pop()
-        print(f' getting a comment chain {current_chain}')
-        json_url = base_url + current_chain + '.json?threaded=false'
-        res = requests.get(json_url, headers={'User-Agent': USER_AGENT})
+    def get_chain(json_url):
+        print(f' getting a comment chain {json_url}')
+        res, result = fetcher.get_extracted(json_url, lambda res: extract_from_reddit_listing(res.json(), json_url),
+                                            headers={'User-Agent': USER_AGENT})
         if res.status_code != 200:
             res.raise_for_status()
-        data = res.json()
-        for listing in data:
-            if listing['kind'].lower() != 'listing':
-                raise ParsingError(json_url)
-            children = listing['data']['children']
-            for child in children:
-                text = None
-                if child['kind'] == 't3':
-                    text = child['data']['selftext_html']
-                elif child['kind'] == 't1':
-                    text = child['data']['body_html']
-                elif child['kind'] == 'more':
-                    chains.extend(['/thread/' + chain for chain in child['data']['children']])
-                else:
-                    raise ParsingError(json_url)
-                if text is not None and len(text) > 0:
-                    soup = BeautifulSoup(html.unescape(text), 'lxml')
-                    new_urls = set(a.get('href') for a in soup.find_all('a'))
-                    urls.update(url for url in new_urls if re.match(PATTERNS['itch_game'], url))
-                    has_more.update(url for url in new_urls if re.match(PATTERNS['itch_group'], url))
-        print(f' sleeping for {sleep_time}s')
-        sleep(sleep_time)
-    print(f' got {len(urls)} games | {len(has_more)} collections/sales')
+        return result
+
+    def get_batch(chains):
+        json_url = (f'{REDDIT_API}/api/morechildren.json?api_type=json'
+                    f"&link_id=t3_{thread_id}&children={','.join(chains)}")
+        print(f' getting {len(chains)} collapsed comments')
+        try:
+            res, result = fetcher.get_extracted(json_url, lambda res: extract_from_more_children(res.json(), json_url),
+                                                headers={'User-Agent': USER_AGENT})
+            if res.status_code != 200:
+                res.raise_for_status()
+            return [result]
+        except (requests.RequestException, ParsingError, ValueError) as e:
+            print(f' getting {len(chains)} collapsed comments failed ({e!r}), getting them one by one')
+            return [get_chain(chain_url(chain)) for chain in chains]
+
+    def chain_url(chain):
+        return base_url + '/thread/' + chain + '.json?threaded=false'
+
+    thread_id = COMPILED_PATTERNS['reddit_thread_id'].match(url)['id']
+    # newest comments first, so the known ones can be skipped when rechecking
+    results = [get_chain(base_url + '.json?threaded=false' + ('&sort=new' if incremental else ''))]
+    with ThreadPoolExecutor(fetcher.max_in_flight) as executor:
+        while len(results) > 0:
+            chains = []
+            for new_urls, new_more, new_chains, comments, new_newest in results:
+                urls.update(new_urls)
+                has_more.update(new_more)
+                chains.extend(new_chains)
+                seen.update(comments)
+                newest = max(newest, new_newest)
+            # stop at comments that were already scanned or requested
+            chains = [chain for chain in dict.fromkeys(chains) if chain not in seen and chain not in expanded]
+            expanded.update(chains)
+            if batch:
+                batches = [chains[i:i+MORE_CHILDREN_LIMIT] for i in range(0, len(chains), MORE_CHILDREN_LIMIT)]
+                results = [result for batch_results in executor.map(get_batch, batches) for result in batch_results]
+            else:
+                results = list(executor.map(get_chain, map(chain_url, chains)))
+    if incremental:
+        print(f' {"no new comments" if newest == known_newest else "new comments"} since the last scan')
+    scan_state.update({'seen': sorted(seen), 'expanded': sorted(expanded), 'newest': newest})
+    print(f' got {len(urls)} games | {len(has_more)} collections/sales from {url}')
     return urls, has_more
 
 
-def get_urls(url, sleep_time=15, max_page=None):
-    global PATTERNS
+def get_urls(url, max_page=None, fetcher=None, scan_state=None, batch=True, sale_info=None):
+    '''
+    `scan_state` and `batch` are used for reddit threads, see get_from_reddit_thread
+    `sale_info` is used for sales, see get_from_itch_group
+    '''
+    global COMPILED_PATTERNS
 
     print(f'getting games from {url}')
-    if re.match(PATTERNS['itch_collection'], url):
-        return get_from_itch_group(url, sleep_time, max_page)
-    elif re.match(PATTERNS['itch_sale'], url):
-        return get_from_itch_group(url, sleep_time, sale=True)
-    elif re.match(PATTERNS['reddit_thread'], url):
-        return get_from_reddit_thread(url, sleep_time)
+    if COMPILED_PATTERNS['itch_collection'].match(url):
+        return get_from_itch_group(url, max_page, fetcher=fetcher)
+    elif COMPILED_PATTERNS['itch_sale'].match(url):
+        return get_from_itch_group(url, sale=True, fetcher=fetcher, sale_info=sale_info)
+    elif COMPILED_PATTERNS['reddit_thread'].match(url):
+        return get_from_reddit_thread(url, fetcher=fetcher, scan_state=scan_state, batch=batch)
     else:
         # breakpoint()
         raise NotImplementedError(f'{url} is not supported')
 
 
-def claim(url, driver):
+def classify_page_state(url, state):
     '''
     INPUTS
-      url     game url
-      driver  a webdriver for a browser that is logged in to itch.io
+      url    game url
+      state  a dict describing the game page, see PAGE_STATE_SCRIPT
+    OUTPUT
+      a status like claim(), or 'claim' if the game should be claimed
+    '''
+    # removed game
+    if state['not_found']:
+        return 'removed'
+
+    # already owned
+    if state['owned'] is not None and 'You own this' in state['owned']:
+        print(f' already claimed: {url}')
+        return 'claimed'
+
+    # check if claimable, download only, or a web game
+    buy = state['buy']
+    if buy is None:
+        if state['uploads']:
+            print(f' download only: {url}')
+            return 'dl_only'
+        elif state['web']:
+            print(f' web game: {url}')
+            return 'web'
+        else:
+            raise ParsingError(url)
+
+    if 'Download Now' in buy:
+        if state['sale_rate'] is None:
+            print(f' always free: {url}')
+            return 'always_free'
+        elif '100' in state['sale_rate']:
+            print(f' download only: {url}')
+            return 'dl_only'
+        else:
+            raise ParsingError(url)
+    elif 'buy now' in buy.lower():
+        print(f' buy: {url}')
+        return 'buy'
+    elif 'pre-order' in buy.lower():
+        print(f' buy (pre-order): {url}')
+        return 'buy'
+    elif 'Download or claim' in buy:
+        return 'claim'
+    else:
+        raise ParsingError(url)
+
+
+def canonical_game_url(url):
+    '''The url claim() uses for a game url'''
+    global COMPILED_PATTERNS
+
+    return f"https://{COMPILED_PATTERNS['itch_game'].search(url)['game']}"
+
+
+def xpath_class(name):
+    '''XPath predicate that matches elements with the css class `name`'''
+    return f"[contains(concat(' ', normalize-space(@class), ' '), ' {name} ')]"
+
+
+@METRICS.timed('parse_seconds')
+def page_state_from_html(game_page):
+    '''
+    INPUT  html game page, or a page parsed by lxml.html
+    OUTPUT the same dict that PAGE_STATE_SCRIPT returns in the browser
+    '''
+    tree = game_page if isinstance(game_page, lxml.html.HtmlElement) else lxml.html.fromstring(game_page)
+
+    def text(xpath):
+        found = tree.xpath(xpath)
+        return found[0].text_content() if found else None
+
+    buy = text(f"//div{xpath_class('buy_row')}//a{xpath_class('buy_btn')}")
+    if buy is None:
+        buy = text(f"//section{xpath_class('game_download')}//a{xpath_class('buy_btn')}")
+    return {
+        'not_found': bool(tree.xpath(f"//div{xpath_class('not_found_game_page')}")),
+        'owned': text(f"//div{xpath_class('purchase_banner_inner')}//h2"),
+        'buy': buy,
+        'sale_rate': text(f"//*{xpath_class('sale_rate')}"),
+        'uploads': bool(tree.xpath(f"//div{xpath_class('uploads')}")),
+        'web': bool(tree.xpath(f"//div{xpath_class('html_embed_widget')}")),
+    }
+
+
+def preclassify(urls, fetcher=None, session=None):
+    '''
+    Classify game pages over plain http, without using the browser
+    INPUTS
+      urls     game urls, they are requested in parallel
+      fetcher  paces the requests, see Fetcher
+      session  a requests session that is logged in to itch.io, so the games the user owns are 'claimed' like in claim()
+               without it, only the statuses in ANONYMOUS_STATUSES are returned
+    OUTPUT
+      a dict of url: status like claim()
+        'claim'  the game should be claimed in the browser
+        None     the page could not be classified, the browser should handle it
+    '''
+    global USER_AGENT, ANONYMOUS_STATUSES
+
+    if fetcher is None:
+        fetcher = Fetcher()
+
+    def classify(url):
+        game_url = canonical_game_url(url)
+        try:
+            res = fetcher.get(game_url, session=session, headers={'User-Agent': USER_AGENT})
+        except requests.RequestException as re_e:
+            print(f' could not check {game_url}: {re_e!r}')
+            return None
+        if res.status_code not in (200, 404):
+            return None
+        try:
+            status = classify_page_state(game_url, page_state_from_html(res.content))
+        except ParsingError:
+            return None
+        if session is None and status not in ANONYMOUS_STATUSES:
+            return None
+        return status
+
+    urls = sorted(urls)
+    with ThreadPoolExecutor(fetcher.max_in_flight) as executor:
+        return dict(zip(urls, executor.map(classify, urls)))
+
+
+def session_from_driver(driver):
+    '''A requests session with the cookies of a driver that is logged in to itch.io'''
+    session = create_session()
+    for cookie in driver.get_cookies():
+        session.cookies.set(cookie['name'], cookie['value'], domain=cookie.get('domain'), path=cookie.get('path', '/'))
+    return session
+
+
+def session_from_profile(profile_dir):
+    '''
+    A requests session with the itch.io cookies of the firefox profile `profile_dir`, without starting firefox
+    the cookies are read from a copy of its database, firefox may be using the profile
+    OUTPUT the session, None if the profile has no cookies
+    '''
+    path = os.path.join(profile_dir, 'cookies.sqlite')
+    if not os.path.exists(path):
+        return None
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # the cookies that firefox didn't checkpoint yet are in the write ahead log
+        for suffix in ('', '-wal'):
+            if os.path.exists(path + suffix):
+                shutil.copy(path + suffix, os.path.join(temp_dir, 'cookies.sqlite' + suffix))
+        connection = sqlite3.connect(os.path.join(temp_dir, 'cookies.sqlite'))
+        try:
+            cookies = connection.execute("SELECT name, value, host, path FROM moz_cookies "
+                                         "WHERE host = 'itch.io' OR host LIKE '%.itch.io'").fetchall()
+        except sqlite3.Error as e:
+            print(f' could not read the cookies of {profile_dir}: {e!r}')
+            return None
+        finally:
+            connection.close()
+    session = create_session()
+    for name, value, host, cookie_path in cookies:
+        session.cookies.set(name, value, domain=host, path=cookie_path)
+    return session
+
+
+def is_logged_in(session):
+    '''True if `session` is logged in to itch.io, the library redirects to the login page otherwise'''
+    global LIBRARY_URL
+
+    try:
+        res = session.get(LIBRARY_URL, allow_redirects=False, timeout=timeout_for(LIBRARY_URL))
+    except requests.RequestException as re_e:
+        print(f' could not check the login: {re_e!r}')
+        return False
+    return res.status_code == 200
+
+
+def log_in(driver, headless=False):
+    '''
+    Log in to itch.io in `driver`, the login of its profile is used if it's still valid
+    OUTPUT a requests session with the login, see session_from_driver
+    '''
+    # the cookies of the profile are only readable on an itch.io page
+    driver.get('https://itch.io')
+    session = session_from_driver(driver)
+    if is_logged_in(session):
+        print('still logged in to itch from the last run')
+        return session
+    if headless:
+        sys.exit('not logged in to itch, run once without --headless to log in')
+    driver.get('https://itch.io/login')
+    # manually log in
+    input('A new Firefox window was opened. Log in to itch then click enter to continue')
+    return session_from_driver(driver)
+
+
+def get_owned_games(session, fetcher=None):
+    '''
+    INPUTS
+      session  a requests session that is logged in to itch.io, see session_from_driver
+      fetcher  paces the requests, see Fetcher
+    OUTPUT
+      urls of the games in the user's library, as returned by canonical_game_url
+    '''
+    global LIBRARY_URL
+
+    if fetcher is None:
+        fetcher = Fetcher()
+    owned = set()
+
+    def get_page(page):
+        print(f' getting library page {page}')
+        res = fetcher.get(LIBRARY_URL, session=session, params={'page': page})
+        if res.status_code == 404:
+            return None
+        elif res.status_code != 200:
+            res.raise_for_status()
+        urls, _ = extract_from_itch_group(res.content)
+        return urls or None
+
+    page = 1
+    with ThreadPoolExecutor(fetcher.max_in_flight) as executor:
+        while True:
+            pages = range(page, page + fetcher.max_in_flight)
+            done = False
+            for urls in executor.map(get_page, pages):
+                if urls is None:
+                    done = True
+                    break
+                owned.update(canonical_game_url(url) for url in urls)
+            if done:
+                break
+            page += fetcher.max_in_flight
+    print(f' {len(owned)} games are in your library')
+    return owned
+
+
+def claim_over_http(url, session, before_claim=None):
+    '''
+    Claim a game without the browser, going through the same pages as claim()
+    INPUTS
+      url           game url
+      session       a requests session that is logged in to itch.io, see session_from_driver
+      before_claim  called before claiming a claimable game
+    OUTPUT
+      status, see claim()
+    raises ParsingError for pages it can't handle, claim() should be used for those
+    raises Throttled when itch refuses the requests
+    '''
+    url = canonical_game_url(url)
+    print(f'handling {url} over http')
+
+    def parse(res):
+        if res.status_code == 429:
+            raise Throttled(url)
+        if res.status_code not in (200, 404):
+            raise ParsingError(url)
+        return lxml.html.fromstring(res.content, base_url=res.url)
+
+    def text(tree, xpath):
+        found = tree.xpath(xpath)
+        return found[0].text_content() if found else None
+
+    def request(method, request_url, **kwargs):
+        with METRICS.timer('http_request_seconds', host=host_label(request_url)):
+            res = session.request(method, request_url, timeout=timeout_for(request_url), **kwargs)
+        METRICS.count('http_bytes', len(res.content), host=host_label(request_url))
+        return res
+
+    tree = parse(request('GET', url))
+    status = classify_page_state(url, page_state_from_html(tree))
+    if status != 'claim':
+        return status
+    if before_claim is not None:
+        before_claim()
+
+    tree = parse(request('GET', f'{url}/purchase'))
+    no_thanks = tree.xpath(f"//a{xpath_class('direct_download_btn')}")
+    if not no_thanks or 'No thanks, just take me to the downloads' not in no_thanks[0].text_content():
+        raise ParsingError(url)
+    download_url = urljoin(tree.base_url, no_thanks[0].get('href'))
+
+    tree = parse(request('GET', download_url))
+    forms = tree.xpath(f"//div{xpath_class('claim_to_download_box')}//form")
+    buttons = forms[0].xpath('.//button') if forms else []
+    if not buttons or 'claim' not in buttons[0].text_content().lower():
+        raise ParsingError(url)
+    form, button = forms[0], buttons[0]
+    # the hidden inputs include the csrf token
+    fields = dict(form.form_values())
+    if button.get('name'):
+        fields[button.get('name')] = button.get('value', '')
+
+    tree = parse(request(form.method, form.action, data=fields))
+    message = text(tree, f"//div{xpath_class('game_download_page')}//div{xpath_class('inner_column')}//p")
+    if message is None:
+        raise ParsingError(url)
+    if 'for the promotion' in message:
+        print(f' just claimed | part of a sale: {url}')
+        return 'claimed has_more'
+    if 'You claimed this game' in message:
+        print(f' just claimed: {url}')
+        return 'claimed'
+    else:
+        raise ParsingError(url)
+
+
+def claim(url, driver, before_claim=None):
+    '''
+    INPUTS
+      url           game url
+      driver        a webdriver for a browser that is logged in to itch.io
+      before_claim  called before claiming a claimable game
     OUTPUT
       status
         'claimed'           success
@@ -242,105 +1554,60 @@ def claim(url, driver):
         'removed'           game does not exist
         'always_free'       dl_only game that is always free
     '''
-    global PATTERNS
+    global PAGE_STATE_SCRIPT
 
-    url = f"https://{re.search(PATTERNS['itch_game'], url)['game']}"
+    url = canonical_game_url(url)
     print(f'handling {url}')
 
-    driver.get(url)
+    with METRICS.timer('browser_seconds', step='page load'):
+        driver.get(url)
     original_window = driver.current_window_handle
     assert len(driver.window_handles) == 1
 
-    # removed game
-    try:
-        driver.find_element_by_css_selector('div.not_found_game_page')
-        return 'removed'
-    except NoSuchElementException:
-        pass
+    with METRICS.timer('browser_seconds', step='page state'):
+        state = driver.execute_script(PAGE_STATE_SCRIPT)
+    status = classify_page_state(url, state)
+    if status != 'claim':
+        return status
+    if before_claim is not None:
+        before_claim()
 
-    # already owned
-    try:
-        if 'You own this' in driver.find_element_by_css_selector('div.purchase_banner_inner h2').get_attribute('textContent'):
-            print(f' already claimed: {url}')
-            return 'claimed'
-    except NoSuchElementException:
-        pass
+    # claim
+    #buy.location_once_scrolled_into_view
+    #buy.click()
+    with METRICS.timer('browser_seconds', step='page load'):
+        driver.get(f'{url}/purchase')
 
-    # check if claimable, download only, or a web game
     try:
-        buy = driver.find_element_by_css_selector('div.buy_row a.buy_btn')
-    except NoSuchElementException:
-        try:
-            buy = driver.find_element_by_css_selector('section.game_download a.buy_btn')
-        except NoSuchElementException:
-            try:
-                driver.find_element_by_css_selector('div.uploads')
-                print(f' download only: {url}')
-                return 'dl_only'
-            except NoSuchElementException:
-                try:
-                    driver.find_element_by_css_selector('div.html_embed_widget')
-                    print(f' web game: {url}')
-                    return 'web'
-                except NoSuchElementException as nse_e:
-                    raise ParsingError(url) from nse_e
+        no_thanks = wait_for_element(driver, 'a.direct_download_btn')
+    except selenium_exceptions.NoSuchElementException as nse_e:
+        raise ParsingError(url) from nse_e
 
-    if 'Download Now' in buy.get_attribute('textContent'):
-        try:
-            sale_rate = driver.find_element_by_css_selector('.sale_rate')
-        except NoSuchElementException as nse_e:
-            print(f' always free: {url}')
-            return 'always_free'
-        else:
-            if '100' in sale_rate.get_attribute('textContent'):
-                print(f' download only: {url}')
-                return 'dl_only'
-            else:
-                raise ParsingError(url)
-    elif 'buy now' in buy.get_attribute('textContent').lower():
-        print(f' buy: {url}')
-        return 'buy'
-    elif 'pre-order' in buy.get_attribute('textContent').lower():
-        print(f' buy (pre-order): {url}')
-        return 'buy'
-    # claim
-    elif 'Download or claim' in buy.get_attribute('textContent'):
-        #buy.location_once_scrolled_into_view
-        #buy.click()
-        driver.get(f'{url}/purchase')
+    if 'No thanks, just take me to the downloads' in no_thanks.get_attribute('textContent'):
+        no_thanks.click()
+
+        # in case the download page opens in a new window
+        original_window = switch_to_new_window(driver, original_window, no_thanks)
 
         try:
-            no_thanks = driver.find_element_by_css_selector('a.direct_download_btn')
-        except NoSuchElementException as nse_e:
+            claim_btn = wait_for_element(driver, 'div.claim_to_download_box form button')
+        except selenium_exceptions.NoSuchElementException as nse_e:
             raise ParsingError(url) from nse_e
 
-        if 'No thanks, just take me to the downloads' in no_thanks.get_attribute('textContent'):
-            no_thanks.click()
-
-            # in case the download page opens in a new window
-            original_window = switch_to_new_window(driver, original_window)
+        if 'claim' in claim_btn.get_attribute('textContent').lower():
+            claim_btn.click()
 
             try:
-                claim_btn = driver.find_element_by_css_selector('div.claim_to_download_box form button')
-            except NoSuchElementException as nse_e:
+                message = wait_for_element(driver, 'div.game_download_page div.inner_column p')
+            except selenium_exceptions.NoSuchElementException as nse_e:
                 raise ParsingError(url) from nse_e
 
-            if 'claim' in claim_btn.get_attribute('textContent').lower():
-                claim_btn.click()
-
-                try:
-                    message = driver.find_element_by_css_selector('div.game_download_page div.inner_column p')
-                except NoSuchElementException as nse_e:
-                    raise ParsingError(url) from nse_e
-
-                if 'for the promotion' in message.get_attribute('textContent'):
-                    print(f' just claimed | part of a sale: {url}')
-                    return 'claimed has_more'
-                if 'You claimed this game' in message.get_attribute('textContent'):
-                    print(f' just claimed: {url}')
-                    return 'claimed'
-                else:
-                    raise ParsingError(url)
+            if 'for the promotion' in message.get_attribute('textContent'):
+                print(f' just claimed | part of a sale: {url}')
+                return 'claimed has_more'
+            if 'You claimed this game' in message.get_attribute('textContent'):
+                print(f' just claimed: {url}')
+                return 'claimed'
             else:
                 raise ParsingError(url)
         else:
@@ -349,24 +1616,304 @@ def claim(url, driver):
         raise ParsingError(url)
 
 
-def create_driver(enable_images=False, mute=False):
+def create_driver(enable_images=False, mute=False, headless=False, profile_dir=None, block=True):
+    '''
+    INPUTS
+      headless     run firefox without a window
+      profile_dir  firefox profile directory that is kept between runs, with the login (None: a new temporary profile)
+      block        block what claim() doesn't need, see BLOCKING_PREFERENCES
+    '''
+    global BLOCKING_PREFERENCES
+
     options = webdriver.firefox.options.Options()
+    if headless:
+        options.add_argument('-headless')
+    if profile_dir is not None:
+        os.makedirs(profile_dir, exist_ok=True)
+        options.add_argument('-profile')
+        options.add_argument(os.path.abspath(profile_dir))
     if not enable_images:
         options.set_preference('permissions.default.image', 2)
     if mute:
         options.set_preference('media.volume_scale', '0.0')
-    if os.path.exists('geckodriver.exe'):
-        driver = webdriver.Firefox(options=options, executable_path='geckodriver.exe')
-    else:
-        # geckodriver should be in PATH
-        driver = webdriver.Firefox(options=options)
-    driver.implicitly_wait(10)
+    if block:
+        for name, value in BLOCKING_PREFERENCES.items():
+            options.set_preference(name, value)
+    # pages are used as soon as their html is parsed, without waiting for images and subresources
+    options.page_load_strategy = 'eager'
+    with METRICS.timer('browser_seconds', step='start'):
+        if os.path.exists('geckodriver.exe'):
+            driver = webdriver.Firefox(options=options, executable_path='geckodriver.exe')
+        else:
+            # geckodriver should be in PATH
+            driver = webdriver.Firefox(options=options)
+    # no implicit wait: missing elements are expected while classifying pages,
+    # elements that load after a click are waited for explicitly
+    driver.implicitly_wait(0)
     return driver
 
 
-def switch_to_new_window(driver, original_window):
-    '''If a new window was opened, switch to it'''
-    sleep(1)
+def copy_profile(profile_dir):
+    '''
+    A copy of the firefox profile `profile_dir` in a temporary directory, with its login, for a firefox
+    that runs next to the one using `profile_dir`, a profile can only be used by one firefox at a time
+    the caches and the lock of the profile aren't copied, the caller removes the copy
+    '''
+    import tempfile
+
+    copy = tempfile.mkdtemp(prefix=os.path.basename(os.path.abspath(profile_dir)) + '.')
+    shutil.copytree(profile_dir, copy, dirs_exist_ok=True,
+                    ignore=shutil.ignore_patterns('lock', '.parentlock', 'parent.lock', 'cache2', 'startupCache'))
+    return copy
+
+
+def log_in_with_cookies(driver, cookies):
+    '''Copy the itch.io session `cookies` of a logged in driver to `driver`'''
+    # cookies can only be added for the domain of the current page
+    driver.get('https://itch.io')
+    for cookie in cookies:
+        driver.add_cookie(cookie)
+
+
+class Backoff:
+    '''
+    pause shared by all browsers when itch throttles
+      delays  (initial, maximum) pause in seconds, the pause doubles each time until a game succeeds
+    '''
+    def __init__(self, delays=THROTTLE_BACKOFF):
+        self.initial, self.maximum = delays
+        self.delay = 0
+        self.until = 0
+        self.lock = threading.Lock()
+
+    def throttled(self):
+        with self.lock:
+            self.delay = min(self.maximum, self.delay * 2 if self.delay else self.initial)
+            self.until = max(self.until, monotonic() + self.delay)
+            return self.delay
+
+    def succeeded(self):
+        with self.lock:
+            self.delay = 0
+
+    def wait(self, stop):
+        '''Block until the pause is over or `stop` is set'''
+        remaining = self.until - monotonic()
+        if remaining > 0:
+            with METRICS.timer('sleep_seconds', reason='throttled'):
+                stop.wait(remaining)
+
+
+def claim_with_workers(urls, driver, history, workers=CLAIM_WORKERS, claim_rate=CLAIM_RATE,
+                       ignore_errors=False, enable_images=False, mute=False, session=None, deadlines=None,
+                       view_rate=VIEW_RATE, block=True, work_queue=None, worker_name=None):
+    '''
+    Claim games with several browsers
+    INPUTS
+      urls           games to claim, ignored if `work_queue` is given
+      driver         a webdriver that is logged in to itch.io, used as the first worker
+      history        updated with the results, only by the calling thread, None if `work_queue` is given
+      workers        number of browsers, the extra ones are headless and use the cookies of `driver`
+      claim_rate     starting rate of claims per second across all browsers (None: no limit)
+      ignore_errors  record games that raise ParsingError as errors instead of stopping
+      session        a requests session logged in to itch.io, games are claimed over http with it
+                     and the browsers only handle the pages claim_over_http() can't
+      deadlines      a dict of game url: unix time when its sale ends, games are claimed earliest deadline first
+      view_rate      starting rate of game pages visited per second across all browsers (None: no limit)
+      block          the extra browsers block what claim() doesn't need, see create_driver
+      work_queue     a WorkQueue shared with other processes, games are leased from it by `worker_name`
+                     until it's empty, and the results are recorded in it
+    games that don't need to be claimed only use the page view budget, see AdaptiveThrottle
+    On Ctrl+C the browsers finish their current game, every result is recorded in `history`,
+    then KeyboardInterrupt is raised again, a second Ctrl+C raises it without waiting for the browsers
+    '''
+    global THROTTLE_SCRIPT, THROTTLE_RETRIES
+
+    if deadlines is None:
+        deadlines = dict()
+    # games without a deadline are claimed last
+    todo = queue.PriorityQueue()
+    if work_queue is None:
+        for url in urls:
+            todo.put((deadlines.get(url, float('inf')), url))
+        total = todo.qsize()
+    else:
+        total = sum(work_queue.counts().get(state, 0) for state in ('queued', 'leased'))
+    results = queue.Queue()
+    stop = threading.Event()
+    views = AdaptiveThrottle('page view', view_rate)
+    claims = AdaptiveThrottle('claim', claim_rate)
+    backoff = Backoff()
+    cookies = driver.get_cookies()
+
+    def claim_game(url, worker_driver, claimed):
+        def before_claim():
+            if not claims.take('claims', stop):
+                raise ClaimStopped(url)
+            # waiting for the claim budget can outlast the lease
+            if work_queue is not None and not work_queue.renew(worker_name, url):
+                raise LeaseLost(url)
+            claimed.append(url)
+        if session is not None:
+            try:
+                with METRICS.timer('claim_seconds', method='http', outcome=None) as labels:
+                    labels['outcome'] = claim_over_http(url, session, before_claim)
+                    return labels['outcome']
+            except Throttled:
+                raise
+            except (ParsingError, requests.RequestException) as e:
+                print(f' using the browser for {url}: {e!r}')
+        with METRICS.timer('claim_seconds', method='browser', outcome=None) as labels:
+            labels['outcome'] = claim(url, worker_driver, None if claimed else before_claim)
+            return labels['outcome']
+
+    def next_game():
+        '''(deadline, url) of the next game to claim, None when there are no games left'''
+        if work_queue is not None:
+            return work_queue.lease(worker_name)
+        try:
+            return todo.get_nowait()
+        except queue.Empty:
+            return None
+
+    def retry_later(deadline, url):
+        if work_queue is not None:
+            work_queue.release(worker_name, url)
+        else:
+            todo.put((deadline, url))
+
+    def work(worker_driver):
+        retries = dict()
+        while not stop.is_set():
+            backoff.wait(stop)
+            if stop.is_set():
+                break
+            # the page view budget is taken before the lease, so the lease isn't spent waiting for it
+            if not views.take('views', stop):
+                break
+            game = next_game()
+            if game is None:
+                break
+            deadline, url = game
+            claimed = [] # not empty if a claim was attempted
+            try:
+                result = claim_game(url, worker_driver, claimed)
+            except LeaseLost:
+                print(f' the lease of {url} expired, leaving it to the other workers')
+                continue
+            except ClaimStopped:
+                retry_later(deadline, url)
+                break
+            except ParsingError as pe:
+                if isinstance(pe, Throttled) or worker_driver.execute_script(THROTTLE_SCRIPT):
+                    views.pushback('views', 'throttled or captcha')
+                    if claimed:
+                        claims.pushback('claims', 'throttled or captcha')
+                    retries[url] = retries.get(url, 0) + 1
+                    if retries[url] <= THROTTLE_RETRIES:
+                        print(f' itch is throttling, all browsers pause for {backoff.throttled()}s')
+                        retry_later(deadline, url)
+                        continue
+                results.put((url, None, pe))
+            except Exception as e:
+                results.put((url, None, e))
+            else:
+                backoff.succeeded()
+                views.healthy('views')
+                if claimed:
+                    claims.healthy('claims')
+                results.put((url, result, None))
+
+    def run(worker_id):
+        try:
+            if worker_id == 0:
+                work(driver)
+            else:
+                with create_driver(enable_images, mute, headless=True, block=block) as worker_driver:
+                    log_in_with_cookies(worker_driver, cookies)
+                    work(worker_driver)
+        except Exception as e:
+            results.put((None, None, e))
+        finally:
+            results.put(None) # this worker is done
+
+    threads = [threading.Thread(target=run, args=(i,), daemon=True) for i in range(workers)]
+    for thread in threads:
+        thread.start()
+
+    done = 0
+    running = len(threads)
+    error = None
+    while running > 0:
+        try:
+            try:
+                item = results.get(timeout=1)
+            except queue.Empty:
+                continue
+            if item is None:
+                running -= 1
+                continue
+            url, result, e = item
+            if e is None:
+                done += 1
+                if work_queue is not None:
+                    print(f'{done}/{total}')
+                    if not work_queue.complete(worker_name, url, result):
+                        print(f' the lease of {url} expired, its result is dropped')
+                        continue
+                    RUN_LOG.write('status', url=url, status=result, worker=worker_name)
+                else:
+                    print(f"{done}/{total} ({len(history['urls'])})")
+                    update_history(history, url, result)
+                continue
+            if url is not None:
+                if work_queue is not None:
+                    if work_queue.complete(worker_name, url, error=repr(e)):
+                        RUN_LOG.write('error', url=url, error=repr(e), worker=worker_name)
+                    else:
+                        print(f' the lease of {url} expired, its error is dropped')
+                else:
+                    record_error(history, url, e)
+            else:
+                RUN_LOG.write('error', error=repr(e))
+            if isinstance(e, ParsingError) and ignore_errors:
+                print(f'Unknown Error: skipping {e.url}')
+            elif error is None:
+                print(f'stopping after an error in {url}')
+                stop.set()
+                error = e
+        except KeyboardInterrupt as ki:
+            if isinstance(error, KeyboardInterrupt):
+                # the second Ctrl+C, the results that weren't received are lost
+                print('stopping without waiting for the browsers')
+                raise
+            print('stopping, waiting for the browsers to finish their current game, press Ctrl+C again to stop now')
+            stop.set()
+            error = ki
+    if error is not None:
+        raise error
+
+
+def wait_for_element(driver, selector, timeout=WAIT_TIMEOUT):
+    '''Wait until an element is in the page, raises NoSuchElementException on timeout'''
+    try:
+        with METRICS.timer('browser_seconds', step='wait for element'):
+            return WebDriverWait(driver, timeout).until(EC.presence_of_element_located((By.CSS_SELECTOR, selector)))
+    except selenium_exceptions.TimeoutException as te:
+        raise selenium_exceptions.NoSuchElementException(f'timed out waiting for {selector}') from te
+
+
+def switch_to_new_window(driver, original_window, clicked, timeout=WAIT_TIMEOUT):
+    '''
+    If a new window was opened, switch to it
+    waits until a new window is opened or the page of the `clicked` element is replaced
+    '''
+    try:
+        with METRICS.timer('browser_seconds', step='wait for new page'):
+            WebDriverWait(driver, timeout).until(
+                lambda driver: len(driver.window_handles) > 1 or EC.staleness_of(clicked)(driver))
+    except selenium_exceptions.TimeoutException:
+        pass
     if len(driver.window_handles) > 1:
         new_handle = None
         for window_handle in driver.window_handles:
@@ -379,35 +1926,541 @@ def switch_to_new_window(driver, original_window):
     return original_window
 
 
-def log(name, data):
-    with open(name, 'a') as f:
-        for k, v in data.items():
-            f.write(k + ': ' + str(v) + '\n')
+def update_history(history, url, result):
+    '''Record the status returned by claim() for `url`, changes are logged to RUN_LOG'''
+    changes = dict()
+    if url in history['error']:
+        history['error'].remove(url)
+        history['old_error'].add(url)
+        changes['was'] = 'error'
+    for key in ('claimed', 'web', 'has_more', 'buy', 'removed', 'always_free', 'dl_only'):
+        if key in result and url not in history[key]:
+            history[key].add(url)
+            changes['status'] = result
+    if len(changes) > 0:
+        RUN_LOG.write('status', url=url, **changes)
+
+
+def record_error(history, url, error):
+    '''Record that `url` caused `error` in the history and RUN_LOG'''
+    history['error'].add(url)
+    RUN_LOG.write('error', url=url, error=repr(error))
+
 
+def history_store_path(name):
+    '''The database of the history file `name` (name.json -> name.db), see HistoryStore'''
+    return os.path.splitext(name)[0] + '.db'
+
+
+def read_history_changes(name):
+    '''
+    The change counter of the database of the history file `name` (see HistoryStore.changes)
+    it's read without creating the database or its tables, None if they don't exist
+    '''
+    path = os.path.abspath(history_store_path(name))
+    if not os.path.exists(path):
+        return None
+    # an sqlite uri by hand, urllib.request.pathname2url imports the http and email modules
+    uri_path = path.replace(os.sep, '/')
+    if not uri_path.startswith('/'):
+        uri_path = '/' + uri_path # C:/... on windows
+    try:
+        connection = sqlite3.connect(f'file:{quote(uri_path)}?mode=ro', uri=True)
+        try:
+            row = connection.execute("SELECT value FROM meta WHERE name = 'changes'").fetchone()
+        finally:
+            connection.close()
+    except sqlite3.Error:
+        return None
+    return 0 if row is None else row[0]
 
+
+class HistoryStore:
+    '''
+    sqlite database next to the history file (name.json -> name.db), every change is written when it happens
+    the json file is an export of the database, it's imported again if it was changed after the last export
+    '''
+    def __init__(self, name):
+        self.name = name
+        self.path = history_store_path(name)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS history (
+            key TEXT NOT NULL, url TEXT NOT NULL, PRIMARY KEY (key, url)) WITHOUT ROWID''')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS state (name TEXT PRIMARY KEY, value TEXT)')
+
+    def get_meta(self, name, default=None):
+        row = self.connection.execute('SELECT value FROM meta WHERE name = ?', (name,)).fetchone()
+        return default if row is None else row[0]
+
+    def set_meta(self, name, value):
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (name, value))
+
+    @contextlib.contextmanager
+    def transaction(self):
+        '''many writes in one transaction, in autocommit mode each row would be its own transaction'''
+        with self.lock:
+            self.connection.execute('BEGIN')
+            try:
+                yield self.connection
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+            self.connection.execute('COMMIT')
+
+    def count_change(self):
+        '''Increase the change counter, see changes()'''
+        self.connection.execute("INSERT INTO meta VALUES ('changes', 1) ON CONFLICT (name) DO UPDATE SET value = value + 1")
+
+    def changes(self):
+        '''Number of changes to the history so far, e.g. to know if a summary of it is outdated'''
+        return self.get_meta('changes', 0)
+
+    def add(self, key, urls):
+        with self.transaction() as connection:
+            connection.executemany('INSERT OR IGNORE INTO history VALUES (?, ?)', ((key, url) for url in urls))
+            self.count_change()
+
+    def remove(self, key, urls):
+        with self.transaction() as connection:
+            connection.executemany('DELETE FROM history WHERE key = ? AND url = ?', ((key, url) for url in urls))
+            self.count_change()
+
+    def load(self, keys):
+        # urls are interned so the same url is stored once for all keys
+        return {k: set(sys.intern(url) for url, in self.connection.execute('SELECT url FROM history WHERE key = ?', (k,)))
+                for k in keys}
+
+    def replace(self, data):
+        '''Replace the whole content with `data` (a dict of key: urls)'''
+        with self.transaction() as connection:
+            connection.execute('DELETE FROM history')
+            connection.executemany('INSERT OR IGNORE INTO history VALUES (?, ?)',
+                                   ((k, url) for k, urls in data.items() for url in urls))
+            self.count_change()
+
+    def load_state(self, name, default=None):
+        '''State saved with save_state(), e.g. what was scanned in a source'''
+        row = self.connection.execute('SELECT value FROM state WHERE name = ?', (name,)).fetchone()
+        return default if row is None else json.loads(row[0])
+
+    def save_state(self, name, value):
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO state VALUES (?, ?)', (name, json.dumps(value)))
+
+    def json_changed(self):
+        '''True if the json file was changed since the last export, e.g. edited by hand or deleted'''
+        try:
+            mtime = os.stat(self.name).st_mtime_ns
+        except FileNotFoundError:
+            # a missing file is only a change if it was exported before, else the history wasn't saved yet
+            return self.get_meta('exported_mtime') is not None
+        return mtime != self.get_meta('exported_mtime')
+
+
+class HistorySet(set):
+    '''a set of urls in the history that writes its changes to a HistoryStore, and to a GameIndex if it has one'''
+    def __init__(self, store, key, urls=(), index=None):
+        super().__init__(urls)
+        self.store = store
+        self.key = key
+        self.index = index
+
+    def __repr__(self):
+        return repr(set(self))
+
+    def add(self, url):
+        if url not in self:
+            super().add(url)
+            self.store.add(self.key, (url,))
+            if self.index is not None:
+                self.index.add(self.key, (url,))
+
+    def update(self, *others):
+        new = set().union(*others).difference(self)
+        super().update(new)
+        self.store.add(self.key, new)
+        if self.index is not None:
+            self.index.add(self.key, new)
+
+    def discard(self, url):
+        if url in self:
+            self.remove(url)
+
+    def remove(self, url):
+        super().remove(url)
+        self.store.remove(self.key, (url,))
+        if self.index is not None:
+            self.index.remove(self.key, (url,))
+
+    def difference_update(self, *others):
+        removed = self.intersection(set().union(*others))
+        super().difference_update(removed)
+        self.store.remove(self.key, removed)
+        if self.index is not None:
+            self.index.remove(self.key, removed)
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def __isub__(self, other):
+        self.difference_update(other)
+        return self
+
+
+class WorkQueue:
+    '''
+    games to claim shared by claim workers, in other processes or on other machines, see --harvest and --claim-worker
+    a sqlite database that can be on a shared disk, it uses a rollback journal because WAL doesn't work there
+    workers lease games, a lease that expires (a worker crashed) puts its game back in the queue
+    results stay in the queue until the harvest process merges them into the history
+      path   the database
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=DELETE')
+        # state: 'queued', 'leased', 'done' (result is set) or 'error' (error is set)
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS queue (
+            url TEXT PRIMARY KEY, deadline REAL, state TEXT NOT NULL, worker TEXT, lease_until REAL,
+            attempts INTEGER NOT NULL DEFAULT 0, result TEXT, error TEXT)''')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS queue_order ON queue (state, deadline, url)')
+
+    @contextlib.contextmanager
+    def transaction(self):
+        '''a write transaction, other processes wait for it'''
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                yield self.connection
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+            self.connection.execute('COMMIT')
+
+    def enqueue(self, urls, deadlines=None):
+        '''Add games that aren't in the queue yet, returns the number of games added'''
+        deadlines = deadlines or dict()
+        with self.transaction() as connection:
+            before = connection.total_changes
+            connection.executemany("INSERT OR IGNORE INTO queue (url, deadline, state) VALUES (?, ?, 'queued')",
+                                   ((url, deadlines.get(url, float('inf'))) for url in urls))
+            return connection.total_changes - before
+
+    def lease(self, worker, seconds=LEASE_SECONDS):
+        '''
+        Lease the queued game with the earliest deadline to `worker`, games whose lease expired are queued again
+        OUTPUT (deadline, url), or None if there are no games left
+        '''
+        now = time()
+        with self.transaction() as connection:
+            connection.execute("UPDATE queue SET state = 'queued', worker = NULL WHERE state = 'leased' AND lease_until < ?",
+                               (now,))
+            row = connection.execute("SELECT deadline, url FROM queue WHERE state = 'queued' ORDER BY deadline, url LIMIT 1"
+                                     ).fetchone()
+            if row is None:
+                return None
+            connection.execute("UPDATE queue SET state = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1 "
+                               "WHERE url = ?", (worker, now + seconds, row[1]))
+            return row
+
+    def renew(self, worker, url, seconds=LEASE_SECONDS):
+        '''
+        Extend the lease of `worker` on `url`, e.g. before claiming it
+        OUTPUT False if the lease expired and the game was queued again or leased by another worker
+        '''
+        now = time()
+        with self.transaction() as connection:
+            cursor = connection.execute("UPDATE queue SET lease_until = ? "
+                                        "WHERE url = ? AND worker = ? AND state = 'leased' AND lease_until >= ?",
+                                        (now + seconds, url, worker, now))
+            return cursor.rowcount == 1
+
+    def release(self, worker, url):
+        '''Put a leased game back in the queue, e.g. when itch throttles'''
+        with self.transaction() as connection:
+            connection.execute("UPDATE queue SET state = 'queued', worker = NULL "
+                               "WHERE url = ? AND worker = ? AND state = 'leased'", (url, worker))
+
+    def complete(self, worker, url, result=None, error=None):
+        '''
+        Record the status returned by claim() for `url`, or the error it raised
+        OUTPUT False if `worker` lost the lease on `url`, the result isn't recorded then
+        '''
+        with self.transaction() as connection:
+            cursor = connection.execute("UPDATE queue SET state = ?, result = ?, error = ?, worker = NULL "
+                                        "WHERE url = ? AND worker = ? AND state = 'leased'",
+                                        ('error' if error is not None else 'done', result, error, url, worker))
+            return cursor.rowcount == 1
+
+    def take_results(self):
+        '''Remove the finished games from the queue, returns a list of (url, result, error)'''
+        with self.transaction() as connection:
+            results = connection.execute("SELECT url, result, error FROM queue WHERE state IN ('done', 'error')").fetchall()
+            connection.execute("DELETE FROM queue WHERE state IN ('done', 'error')")
+        return results
+
+    def counts(self):
+        '''a dict of state: number of games'''
+        return dict(self.connection.execute('SELECT state, COUNT(*) FROM queue GROUP BY state'))
+
+
+HISTORY_STORES = dict() # history file: HistoryStore
+
+
+def open_history_store(name):
+    global HISTORY_STORES
+
+    path = os.path.abspath(name)
+    if path not in HISTORY_STORES:
+        HISTORY_STORES[path] = HistoryStore(name)
+    return HISTORY_STORES[path]
+
+
+@METRICS.timed('history_seconds')
 def load_history(name):
+    '''
+    INPUT  history json file
+    OUTPUT a dict of HistorySet, changes to them are saved as they happen
+    '''
     global HISTORY_KEYS
 
-    try:
-        f = open(name, 'r')
-        with f:
-            data = json.load(f)
-        print(f'loaded history from file {name}')
-    except FileNotFoundError:
-        data = dict()
-        print(f'new history file will be created: {name}')
-    history = {k: set(data.get(k, [])) for k in HISTORY_KEYS}
+    store = open_history_store(name)
+    if store.json_changed() or store.get_meta('exported_mtime') is None:
+        try:
+            f = open(name, 'r')
+            with f:
+                data = json.load(f)
+            print(f'loaded history from file {name}')
+            store.replace({k: data.get(k, []) for k in HISTORY_KEYS})
+            store.set_meta('exported_mtime', os.stat(name).st_mtime_ns)
+        except FileNotFoundError:
+            if store.get_meta('exported_mtime') is not None:
+                # the history file was deleted, start over like it did before the database
+                store.replace(dict())
+                store.set_meta('exported_mtime', None)
+            print(f'new history file will be created: {name}')
+    else:
+        print(f'loaded history from {store.path}')
+    data = store.load(HISTORY_KEYS)
+    index = GameIndex.from_history(data)
+    history = {k: HistorySet(store, k, urls, index) for k, urls in data.items()}
     return history
 
 
+@METRICS.timed('history_seconds')
 def save_history(name, data):
+    '''
+    Export the history to the json file `name`, `data` is written to the database if it isn't from load_history
+    a summary is written next to it for --show-history and --stats, see summarize
+    OUTPUT the summary
+    '''
+    store = open_history_store(name)
+    if not all(isinstance(v, HistorySet) and v.store is store for v in data.values()):
+        store.replace(data)
     print(f'writing history to file {name}')
-    with open(name, 'w') as f:
+    temp_name = name + '.tmp'
+    with open(temp_name, 'w') as f:
         json.dump({k: list(v) for k, v in data.items()}, f, indent=2)
+    os.replace(temp_name, name)
+    store.set_meta('exported_mtime', os.stat(name).st_mtime_ns)
+    return save_summary(name, data)
+
+
+def summary_file(name):
+    '''The summary of the history file `name` (name.json -> name.summary.json)'''
+    return os.path.splitext(name)[0] + '.summary.json'
+
+
+def save_summary(name, history):
+    '''
+    Write the summary of `history` next to the history file `name`
+    it's valid until the history file or its database changes, see load_summary
+    OUTPUT the summary, see summarize
+    '''
+    summary = dict(summarize(history), history_mtime=os.stat(name).st_mtime_ns,
+                   changes=open_history_store(name).changes(), saved=time())
+    temp_name = summary_file(name) + '.tmp'
+    with open(temp_name, 'w') as f:
+        json.dump(summary, f, indent=2)
+    os.replace(temp_name, summary_file(name))
+    return summary
+
+
+def load_summary(name):
+    '''
+    INPUT  history json file
+    OUTPUT the summary written by save_history, None if there is none, or if the history file or its database
+           changed since, e.g. a run that was killed before it exported the history
+    '''
+    try:
+        with open(summary_file(name), 'r') as f:
+            summary = json.load(f)
+        mtime = os.stat(name).st_mtime_ns
+    except (OSError, ValueError):
+        return None
+    if summary.get('history_mtime') != mtime or summary.get('changes') != read_history_changes(name):
+        return None
+    return summary
 
 
-def print_summary(history_file, history):
-    global SOURCES, PATTERNS, PROCESSED_GAMES
+class GameIndex:
+    '''
+    the games of a history interned to integer ids, with their statuses and flags in arrays (see STATUS_BITS
+    and INDEX_FLAGS), the counts per status and the games without a status are kept up to date
+    the HistorySet of a history from load_history() update its index, see history_index()
+    '''
+    def __init__(self):
+        self.urls = []              # id: url
+        self.ids = dict()           # url: id
+        self.statuses = array('B')  # id: STATUS_BITS of the game
+        self.flags = array('B')     # id: INDEX_FLAGS of the game
+        self.counts = dict.fromkeys(list(STATUS_BITS) + list(INDEX_FLAGS), 0) # history key: games in it
+        self.unprocessed = dict()   # ids of discovered games without a status, a dict keeps the discovery order
+
+    @classmethod
+    def from_history(cls, history):
+        '''The index of a dict of sets, see HISTORY_KEYS'''
+        global STATUS_BITS, INDEX_FLAGS, FLAG_DISCOVERED, COMPILED_PATTERNS
+
+        index = cls()
+        # whole sets at a time, add() is for the changes
+        for key in list(INDEX_FLAGS) + list(STATUS_BITS):
+            urls = history[key]
+            if key == 'has_more':
+                urls = [url for url in urls if COMPILED_PATTERNS['itch_game'].match(url)]
+            new = [url for url in urls if url not in index.ids]
+            index.ids.update(zip(new, range(len(index.urls), len(index.urls) + len(new))))
+            index.urls.extend(new)
+            index.statuses.frombytes(bytes(len(new)))
+            index.flags.frombytes(bytes(len(new)))
+            values, bit = index.bits(key)
+            for game_id in map(index.ids.__getitem__, urls):
+                values[game_id] |= bit
+            index.counts[key] = len(urls)
+        index.unprocessed = dict.fromkeys(game_id for game_id, (status, flags) in enumerate(zip(index.statuses, index.flags))
+                                          if status == 0 and flags & FLAG_DISCOVERED)
+        return index
+
+    def __len__(self):
+        return len(self.urls)
+
+    def intern(self, url):
+        '''The id of `url`, added without statuses or flags if needed'''
+        game_id = self.ids.get(url)
+        if game_id is None:
+            game_id = len(self.urls)
+            self.ids[url] = game_id
+            self.urls.append(url)
+            self.statuses.append(0)
+            self.flags.append(0)
+        return game_id
+
+    def bits(self, key):
+        '''(array, bit) of the history `key`, None if the index doesn't keep it'''
+        global STATUS_BITS, INDEX_FLAGS
+
+        if key in STATUS_BITS:
+            return self.statuses, STATUS_BITS[key]
+        if key in INDEX_FLAGS:
+            return self.flags, INDEX_FLAGS[key]
+        return None
+
+    def add(self, key, urls):
+        '''`urls` were added to the history `key`'''
+        global COMPILED_PATTERNS
+
+        bits = self.bits(key)
+        if bits is None:
+            return
+        values, bit = bits
+        if key == 'has_more':
+            urls = [url for url in urls if COMPILED_PATTERNS['itch_game'].match(url)]
+        added = 0
+        for url in urls:
+            game_id = self.intern(url)
+            if not values[game_id] & bit:
+                values[game_id] |= bit
+                added += 1
+                self.update_unprocessed(game_id)
+        self.counts[key] += added
+
+    def remove(self, key, urls):
+        '''`urls` were removed from the history `key`'''
+        bits = self.bits(key)
+        if bits is None:
+            return
+        values, bit = bits
+        for url in urls:
+            game_id = self.ids.get(url)
+            if game_id is not None and values[game_id] & bit:
+                values[game_id] &= ~bit
+                self.counts[key] -= 1
+                self.update_unprocessed(game_id)
+
+    def update_unprocessed(self, game_id):
+        global FLAG_DISCOVERED
+
+        if self.statuses[game_id] == 0 and self.flags[game_id] & FLAG_DISCOVERED:
+            self.unprocessed.setdefault(game_id)
+        else:
+            self.unprocessed.pop(game_id, None)
+
+    def iter_unprocessed(self, skip_errors=False):
+        '''discovered games without a status, `skip_errors` skips games that caused an error'''
+        global FLAG_ERROR
+
+        for game_id in self.unprocessed:
+            if not (skip_errors and self.flags[game_id] & FLAG_ERROR):
+                yield self.urls[game_id]
+
+
+def history_index(history):
+    '''The GameIndex that the sets of `history` keep up to date, a new one if they don't have one'''
+    index = getattr(history.get('urls'), 'index', None)
+    return index if index is not None else GameIndex.from_history(history)
+
+
+def unprocessed_games(history, skip_errors=False):
+    '''a list of the discovered games without a status, `skip_errors` also skips the games that caused an error'''
+    return list(history_index(history).iter_unprocessed(skip_errors))
+
+
+def summarize(history):
+    '''
+    INPUT  a dict of sets, see HISTORY_KEYS
+    OUTPUT a dict with the counts and the lists of games that print_summary() shows, it can be converted to json
+    '''
+    global COMPILED_PATTERNS, PROCESSED_GAMES
+
+    index = history_index(history)
+    itch_groups = sum(1 for url in history['has_more'] if COMPILED_PATTERNS['itch_group'].match(url))
+    counts = {status: index.counts[status] for status in PROCESSED_GAMES}
+    counts.update({
+        'discovered': index.counts['urls'],
+        'unprocessed': len(index.unprocessed),
+        'groups_to_check': itch_groups,
+        'checked_groups': len(history['checked_groups']),
+        'games_with_more_sales': index.counts['has_more'],
+        'error': index.counts['error'],
+    })
+    return {
+        'counts': counts,
+        'web': list(history['web']),
+        'dl_only': list(history['dl_only']),
+        'error': list(history['error']),
+    }
+
+
+def print_summary(history_file, summary):
+    '''`summary` is from summarize() or load_summary()'''
+    global SOURCES
 
     print('\nSUMMARY')
 
@@ -418,177 +2471,798 @@ def print_summary(history_file, history):
     print(f'History stored in {history_file}')
     print()
 
+    counts = summary['counts']
     print(f'Using {len(SOURCES)} main sources (use --recheck to recheck them)')
-    print(f"Discovered {len(history['urls'])} games")
-    print(f"Claimed {len(history['claimed'])} games")
-    not_processed = history['urls'].difference(*map(history.get, PROCESSED_GAMES))
-    print(f"{len(not_processed)} games should be claimed on the next run")
+    print(f"Discovered {counts['discovered']} games")
+    print(f"Claimed {counts['claimed']} games")
+    print(f"{counts['unprocessed']} games should be claimed on the next run")
     print()
 
-    itch_groups = set(filter(re.compile(PATTERNS['itch_group']).match, history['has_more']))
-    itch_games = set(filter(re.compile(PATTERNS['itch_game']).match, history['has_more']))
-    print(f"{len(itch_groups)} discovered collections / sales should be checked on the next run")
-    print(f"{len(history['checked_groups'])} discovered collections / sales were checked (use --recheck-groups to recheck them)")
-    print(f"{len(itch_games)} discovered games are connected to sales that may not have been checked")
-    print(f"{len(history['removed'])} games were removed or invalid")
+    print(f"{counts['groups_to_check']} discovered collections / sales should be checked on the next run")
+    print(f"{counts['checked_groups']} discovered collections / sales were checked (use --recheck-groups to recheck them)")
+    print(f"{counts['games_with_more_sales']} discovered games are connected to sales that may not have been checked")
+    print(f"{counts['removed']} games were removed or invalid")
     print()
 
-    print(f"Play {len(history['web'])} non-claimable and non-downloadable games online:")
-    for url in history['web']:
+    print(f"Play {counts['web']} non-claimable and non-downloadable games online:")
+    for url in summary['web']:
         print(f'  {url}')
     print()
 
-    print(f"Download {len(history['dl_only'])} non-claimable games manually:")
-    for url in history['dl_only']:
+    print(f"Download {counts['dl_only']} non-claimable games manually:")
+    for url in summary['dl_only']:
         print(f'  {url}')
-    print(f"{len(history['always_free'])} downloadable games are always free (not listed above)")
-    print(f"{len(history['downloaded'])} games were marked as downloaded (to mark games: move them in the history file from 'dl_only' to 'downloaded')")
-    print(f"{len(history['dl_only_old'])} downloadable games were skipped (moved to 'dl_only_old')")
+    print(f"{counts['always_free']} downloadable games are always free (not listed above)")
+    print(f"{counts['downloaded']} games were marked as downloaded (to mark games: move them in the history file from 'dl_only' to 'downloaded')")
+    print(f"{counts['dl_only_old']} downloadable games were skipped (moved to 'dl_only_old')")
     print()
 
-    print(f"Buy {len(history['buy'])} non-free games.")
+    print(f"Buy {counts['buy']} non-free games.")
     print()
 
-    print(f"Error encountered in {len(history['error'])} games (some maybe already solved):")
-    for url in history['error']:
+    print(f"Error encountered in {counts['error']} games (some maybe already solved):")
+    for url in summary['error']:
         print(f'  {url}')
     print()
 
 
-def get_urls_and_update_history(history, sources, itch_groups):
+def get_sales_of_game(url, fetcher=None):
+    '''
+    INPUT  url of a game that is connected to more sales
+    OUTPUT urls of the itch.io sales linked in the game page
+    '''
+    global USER_AGENT, COMPILED_PATTERNS
+
+    if fetcher is None:
+        fetcher = Fetcher()
+    res = fetcher.get(canonical_game_url(url), headers={'User-Agent': USER_AGENT})
+    if res.status_code != 200:
+        return set()
+    tree = lxml.html.fromstring(res.content, base_url=res.url)
+    tree.make_links_absolute()
+    return set(filter(COMPILED_PATTERNS['itch_sale'].match, tree.xpath('//a/@href')))
+
+
+class Frontier:
+    '''
+    deduplicated queue of sources, sales/collections and games connected to sales that should be checked
+    it's saved with HistoryStore.save_state so a run can resume where the last one stopped
+      state      what state() returned in an earlier run
+      max_depth  sales/collections found further than this from SOURCES are not added
+    '''
+    def __init__(self, state=None, max_depth=FRONTIER_DEPTH):
+        self.max_depth = max_depth
+        # url: {'kind': 'source' / 'group' / 'game', 'depth', 'pending', 'fetches', 'new_games'}
+        self.nodes = dict() if state is None else state
+
+    def state(self):
+        return self.nodes
+
+    def add(self, url, depth=None, kind='group', recheck=False):
+        '''
+        Add `url` if it's new, or if `recheck` is set and it was checked before
+        `depth` is the number of links from SOURCES, None keeps the known depth (1 for new urls)
+        urls deeper than max_depth are remembered but not checked,
+        and sales/collections fetched LOW_YIELD_FETCHES times without new games are not rechecked
+        returns True if `url` is pending
+        '''
+        global LOW_YIELD_FETCHES
+
+        node = self.nodes.get(url)
+        if node is None:
+            node = self.nodes[url] = {'kind': kind, 'depth': 1 if depth is None else depth,
+                                      'pending': False, 'fetches': 0, 'new_games': 0}
+        elif depth is not None:
+            node['depth'] = min(node['depth'], depth)
+        if not node['pending'] and node['depth'] <= self.max_depth:
+            low_yield = node['kind'] == 'group' and node['fetches'] >= LOW_YIELD_FETCHES and node['new_games'] == 0
+            node['pending'] = node['fetches'] == 0 or (recheck and not low_yield)
+        return node['pending']
+
+    def pending(self):
+        return [url for url, node in self.nodes.items() if node['pending']]
+
+    def next_batch(self, size):
+        '''The `size` pending urls that produced the most new games per fetch, new urls first'''
+        def priority(url):
+            node = self.nodes[url]
+            return (-(node['new_games'] + 1) / (node['fetches'] + 1), node['depth'], url)
+        return sorted(self.pending(), key=priority)[:size]
+
+    def done(self, url, new_games):
+        node = self.nodes[url]
+        node['pending'] = False
+        node['fetches'] += 1
+        node['new_games'] += new_games
+
+
+def get_urls_and_update_history(history, sources, itch_groups, fetcher=None, scan_states=None, batch=True,
+                                deadlines=None, stats=None):
     '''
     INPUT
       history      a dict that'll be updates as `sources` are processed
-      sources      sources to get links from
+      sources      sources to get links from, they are processed in parallel
       itch_groups  itch sales/collections in `sources` that should be marked as checked in `history`
+      fetcher      paces the requests of all sources, see Fetcher
+      scan_states  a dict of reddit thread url: scan state, see get_from_reddit_thread
+      batch        request collapsed reddit comments in batches, see get_from_reddit_thread
+      deadlines    a dict of game url: unix time when the last sale it's in ends, updated with the sales in `sources`
+      stats        a dict updated with source: (number of new games, urls added to has_more) for each merged source
+    results are merged in the sorted order of `sources`, sources that failed are not merged
     '''
-    for i, source in enumerate(sources):
-        print(f'{i+1}/{len(sources)}')
-        new_urls, new_more = get_urls(source)
-        history['urls'].update(new_urls)
-        history['has_more'].update(new_more)
+    global COMPILED_PATTERNS
+
+    if fetcher is None:
+        fetcher = Fetcher()
+    if scan_states is None:
+        scan_states = dict()
+    if deadlines is None:
+        deadlines = dict()
+    if stats is None:
+        stats = dict()
+    sources = sorted(sources)
+    sale_infos = {source: dict() for source in sources if COMPILED_PATTERNS['itch_sale'].match(source)}
+    # the state of a thread is only updated if it was scanned successfully
+    new_states = {source: dict(scan_states.get(source, {})) for source in sources
+                  if COMPILED_PATTERNS['reddit_thread'].match(source)}
+    error = None
+    with ThreadPoolExecutor(fetcher.max_in_flight) as executor:
+        futures = [executor.submit(get_urls, source, fetcher=fetcher, scan_state=new_states.get(source), batch=batch,
+                                   sale_info=sale_infos.get(source))
+                   for source in sources]
+        for i, (source, future) in enumerate(zip(sources, futures)):
+            try:
+                new_urls, new_more = future.result()
+            except Exception as e:
+                print(f'failed to get games from {source}: {e!r}')
+                RUN_LOG.write('error', url=source, error=repr(e))
+                if error is None:
+                    error = e
+                continue
+            print(f'{i+1}/{len(sources)} {source}')
+            new_games = set(new_urls).difference(history['urls'])
+            stats[source] = (len(new_games), set(new_more).difference(history['has_more']))
+            if len(new_games) + len(stats[source][1]) > 0:
+                RUN_LOG.write('discovered', source=source, urls=new_games, more=stats[source][1])
+            history['urls'].update(new_urls)
+            history['has_more'].update(new_more)
+            if source in new_states:
+                scan_states[source] = new_states[source]
+            end = sale_infos.get(source, {}).get('end')
+            if end is not None:
+                for game in new_urls:
+                    deadlines[game] = max(deadlines.get(game, 0), end)
+    if error is not None:
+        raise error
     history['checked_groups'].update(itch_groups)
     history['has_more'].difference_update(history['checked_groups'])
 
 
+def crawl_frontier(history, frontier, fetcher, store, scan_states, deadlines, batch=True):
+    '''
+    Get the pending urls of `frontier` until none are left, sales/collections found on the way are added to it
+    INPUTS
+      history      a dict that'll be updated with the games found
+      frontier     see Frontier
+      fetcher      paces the requests, see Fetcher
+      store        the HistoryStore where the frontier and the states are saved after each batch
+      scan_states  see get_urls_and_update_history
+      deadlines    see get_urls_and_update_history
+      batch        request collapsed reddit comments in batches, see get_from_reddit_thread
+    '''
+    global COMPILED_PATTERNS
+
+    # keep getting newly discovered sales/collections
+    with ThreadPoolExecutor(fetcher.max_in_flight) as executor:
+        while True:
+            target_sources = frontier.next_batch(fetcher.max_in_flight)
+            if len(target_sources) == 0:
+                break
+            sources = [url for url in target_sources if frontier.nodes[url]['kind'] != 'game']
+            games = [url for url in target_sources if frontier.nodes[url]['kind'] == 'game']
+            found = dict() # url: depth
+            stats = dict()
+            try:
+                if len(sources) > 0:
+                    groups = set(filter(COMPILED_PATTERNS['itch_group'].match, sources))
+                    get_urls_and_update_history(history, sources, groups, fetcher, scan_states,
+                                                batch=batch, deadlines=deadlines, stats=stats)
+                for game, sales in zip(games, executor.map(lambda game: get_sales_of_game(game, fetcher), games)):
+                    print(f'{game} is connected to {len(sales)} sales')
+                    stats[game] = (0, sales)
+            finally:
+                for url, (new_games, new_more) in stats.items():
+                    frontier.done(url, new_games)
+                    for more in new_more:
+                        if COMPILED_PATTERNS['itch_group'].match(more):
+                            if more not in history['checked_groups']:
+                                frontier.add(more, frontier.nodes[url]['depth'] + 1)
+                        elif COMPILED_PATTERNS['itch_game'].match(more):
+                            frontier.add(more, frontier.nodes[url]['depth'] + 1, 'game')
+                store.save_state('frontier', frontier.state())
+                store.save_state('reddit', scan_states)
+                store.save_state('deadlines', deadlines)
+
+
+def games_to_claim(history, games, deadlines, fetcher=None, preclassify_games=True, session=None, owned=None):
+    '''
+    INPUTS
+      history            the games in `owned` and the games preclassify() could classify are recorded in it
+      games              games without a status
+      deadlines          a dict of game url: unix time when its sale ends, the games of sales that ended are skipped
+      fetcher            paces the requests of preclassify(), see Fetcher
+      preclassify_games  check the game pages over http first, see preclassify
+      session            a requests session logged in to itch.io for preclassify(), None if there is no login
+      owned              the games in the user's library (see get_owned_games), they are recorded as claimed
+                         before any game page is requested, None without a library sync
+    OUTPUT
+      the games that should be handled in the browser
+    '''
+    valid = set(games)
+    ended = set(url for url in valid if deadlines.get(url, float('inf')) < time())
+    if len(ended) > 0:
+        print(f'skipping {len(ended)} games from sales that ended')
+        valid.difference_update(ended)
+    if owned is not None:
+        for url in sorted(valid):
+            if canonical_game_url(url) in owned:
+                update_history(history, url, 'claimed')
+        valid.difference_update(history['claimed'])
+        print(f'{len(valid)} games are not in your library')
+    if len(valid) > 0 and preclassify_games:
+        print(f'checking {len(valid)} games without the browser')
+        with METRICS.phase('preclassify'):
+            statuses = preclassify(valid, fetcher, session)
+        valid = set()
+        for url, status in statuses.items():
+            if status is None or status == 'claim':
+                valid.add(url)
+            else:
+                update_history(history, url, status)
+        print(f'{len(valid)} games should be handled in the browser')
+    return valid
+
+
+def is_processed(history, url):
+    '''True if `url` has a status in `history`, see PROCESSED_GAMES'''
+    global PROCESSED_GAMES
+
+    return any(url in history[status] for status in PROCESSED_GAMES)
+
+
+def load_sources(name):
+    '''
+    INPUT  a text file with one source per line, an itch sale/collection or a reddit thread,
+           optionally followed by its poll interval in seconds, or minutes / hours with m / h (e.g. 15m)
+           empty lines and lines starting with # are ignored
+    OUTPUT a dict of source: poll interval in seconds, POLL_INTERVAL if it isn't given
+    '''
+    global POLL_INTERVAL, COMPILED_PATTERNS
+
+    units = {'s': 1, 'm': 60, 'h': 3600}
+    sources = dict()
+    with open(name, 'r') as f:
+        for line_number, line in enumerate(f, 1):
+            fields = line.split()
+            if len(fields) == 0 or fields[0].startswith('#'):
+                continue
+            url = fields[0]
+            if not (COMPILED_PATTERNS['itch_group'].match(url) or COMPILED_PATTERNS['reddit_thread'].match(url)):
+                raise ValueError(f'{name}:{line_number}: not an itch sale/collection or a reddit thread: {url}')
+            interval = POLL_INTERVAL
+            if len(fields) > 1:
+                value = fields[1]
+                unit = units.get(value[-1].lower())
+                try:
+                    interval = float(value[:-1]) * unit if unit is not None else float(value)
+                except ValueError:
+                    raise ValueError(f'{name}:{line_number}: invalid poll interval: {value}') from None
+                if interval <= 0:
+                    raise ValueError(f'{name}:{line_number}: the poll interval must be positive: {value}')
+            sources[url] = interval
+    return sources
+
+
+class Watcher:
+    '''
+    state of watch(), shared with the status server, see serve_status
+      games    games found by the polls that wait to be claimed
+      sources  a dict of source url: {'interval', 'last_poll', 'next_poll', 'last_error', 'fetches', 'new_games'}
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time()
+        self.activity = 'starting' # 'polling', 'claiming', 'sleeping'
+        self.games = set()
+        self.sources = dict()
+        self.handled = 0 # games that left the queue with a status or an error
+
+    def set_sources(self, sources):
+        '''Replace the sources with a dict of url: poll interval, known sources keep their last poll'''
+        with self.lock:
+            for url in set(self.sources).difference(sources):
+                del self.sources[url]
+            for url, interval in sources.items():
+                source = self.sources.setdefault(url, {'interval': interval, 'last_poll': None, 'next_poll': 0,
+                                                       'last_error': None, 'fetches': 0, 'new_games': 0})
+                if source['last_poll'] is not None:
+                    source['next_poll'] = source['last_poll'] + interval
+                source['interval'] = interval
+
+    def due(self, now):
+        '''The sources that should be polled at `now`'''
+        with self.lock:
+            return sorted(url for url, source in self.sources.items() if source['next_poll'] <= now)
+
+    def next_poll(self):
+        with self.lock:
+            return min((source['next_poll'] for source in self.sources.values()), default=float('inf'))
+
+    def polled(self, urls, frontier, now, error=None):
+        '''Record a poll of `urls`, their counts come from `frontier`, see Frontier'''
+        with self.lock:
+            for url in urls:
+                source = self.sources[url]
+                source['last_poll'] = now
+                source['next_poll'] = now + source['interval']
+                source['last_error'] = None if error is None or not frontier.nodes[url]['pending'] else repr(error)
+                source['fetches'] = frontier.nodes[url]['fetches']
+                source['new_games'] = frontier.nodes[url]['new_games']
+
+    def add_games(self, games):
+        with self.lock:
+            self.games.update(games)
+
+    def pending_games(self):
+        with self.lock:
+            return set(self.games)
+
+    def settle(self, history, valid):
+        '''Keep the games of `valid` that don't have a status or an error in `history` yet'''
+        with self.lock:
+            games = set(url for url in valid if not is_processed(history, url) and url not in history['error'])
+            self.handled += len(self.games) - len(games)
+            self.games = games
+
+    def set_activity(self, activity):
+        with self.lock:
+            self.activity = activity
+
+    def status(self):
+        '''The status as a dict that can be converted to json'''
+        with self.lock:
+            return {
+                'started': self.started,
+                'now': time(),
+                'activity': self.activity,
+                'queue': len(self.games),
+                'handled': self.handled,
+                'next_poll': min((source['next_poll'] for source in self.sources.values()), default=None),
+                'sources': {url: dict(source) for url, source in sorted(self.sources.items())},
+            }
+
+
+def serve_status(watcher, port=STATUS_PORT):
+    '''
+    Serve the status of `watcher` as json on http://localhost:port/status
+    and the metrics in prometheus text format on /metrics, see Metrics.to_prometheus
+    OUTPUT the server, it runs in a daemon thread until server.shutdown()
+    '''
+    global METRICS
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    class StatusHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            path = urlsplit(self.path).path
+            if path in ('/', '/status'):
+                body = json.dumps(watcher.status(), indent=2).encode('utf-8')
+                content_type = 'application/json'
+            elif path == '/metrics':
+                body = METRICS.to_prometheus().encode('utf-8')
+                content_type = 'text/plain; version=0.0.4'
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    # only reachable from this computer
+    server = ThreadingHTTPServer(('127.0.0.1', port), StatusHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def watch(sources_file, history_file, history, fetcher, start_browser, claim_games, watcher=None,
+          max_depth=FRONTIER_DEPTH, batch=True, skip_errors=False, preclassify_games=True, library_sync=True,
+          metrics_file=None, run_time=None):
+    '''
+    Poll each source of `sources_file` on its own interval and claim the new games as soon as they are found,
+    until Ctrl+C. The browser, its login and the http connections and cache stay open between polls
+    INPUTS
+      sources_file      see load_sources, it's reloaded when it changes
+      history_file      the history is exported to it after each claim, see save_history
+      history           from load_history, updated with the games found and their status
+      fetcher           paces the requests of the polls and preclassify(), see Fetcher
+      start_browser     a function that returns a webdriver logged in to itch.io and its requests session,
+                        it's called before the first claim, and again if the browser stopped working
+      claim_games       a function(games, driver, session, deadlines) that claims games and records them in `history`
+      watcher           a Watcher that is updated with the state, e.g. for serve_status
+      max_depth         see Frontier
+      batch             request collapsed reddit comments in batches, see get_from_reddit_thread
+      skip_errors       games that caused an error in an earlier run are not claimed
+      preclassify_games check the game pages over http first, see preclassify
+      library_sync      the games in the user's library are recorded as claimed when the browser starts
+      metrics_file      the metrics are written to it after each poll, see Metrics.write
+    the games of the history that were not claimed yet are claimed first
+    '''
+    global SOURCES_FILE_CHECK, METRICS, RUN_LOG
+
+    if watcher is None:
+        watcher = Watcher()
+    store = open_history_store(history_file)
+    frontier = Frontier(store.load_state('frontier'), max_depth)
+    scan_states = store.load_state('reddit', dict())
+    deadlines = store.load_state('deadlines', dict())
+    known = set(history['urls'])
+    watcher.add_games(unprocessed_games(history, skip_errors))
+    sources_mtime = None
+    driver = None
+    session = None
+    owned = None # the games in the library when the browser was started
+    try:
+        while True:
+            mtime = os.stat(sources_file).st_mtime_ns
+            if mtime != sources_mtime:
+                sources = load_sources(sources_file)
+                print(f'watching {len(sources)} sources from {sources_file}')
+                RUN_LOG.write('sources', sources=sources)
+                watcher.set_sources(sources)
+                sources_mtime = mtime
+
+            due = watcher.due(time())
+            if len(due) > 0:
+                watcher.set_activity('polling')
+                print(f"{datetime.now():%Y-%m-%d %H:%M:%S} polling {len(due)} sources")
+                for source in due:
+                    frontier.add(source, 0, 'source', recheck=True)
+                error = None
+                try:
+                    with METRICS.phase('discovery'):
+                        crawl_frontier(history, frontier, fetcher, store, scan_states, deadlines,
+                                       batch=batch)
+                except Exception as e:
+                    print(f'polling failed: {e!r}')
+                    error = e
+                # urls are only added to the history, so the new ones are the ones that aren't known yet
+                new_games = history['urls'].difference(known)
+                known.update(new_games)
+                new_games = set(url for url in new_games if not is_processed(history, url))
+                watcher.polled(due, frontier, time(), error)
+                watcher.add_games(new_games)
+                METRICS.count('watch_polls', len(due), outcome='ok' if error is None else 'error')
+                if len(new_games) > 0:
+                    print(f'found {len(new_games)} new games')
+
+            games = watcher.pending_games()
+            if len(games) > 0:
+                watcher.set_activity('claiming')
+                # the games stay in the queue if the browser can't be started
+                valid = set(games)
+                try:
+                    # logged in before the game pages are checked, they look different for the games the user owns
+                    if driver is None:
+                        with METRICS.phase('login'):
+                            driver, session = start_browser()
+                        if library_sync:
+                            print('getting the games in your library')
+                            with METRICS.phase('library'):
+                                owned = get_owned_games(session, fetcher)
+                    valid = games_to_claim(history, games, deadlines, fetcher, preclassify_games, session, owned)
+                    if len(valid) > 0:
+                        with METRICS.phase('claim'):
+                            claim_games(valid, driver, session, deadlines)
+                except selenium_exceptions.WebDriverException as wde:
+                    print(f'restarting the browser after an error: {wde!r}')
+                    RUN_LOG.write('error', error=repr(wde), action='restart browser')
+                    if driver is not None:
+                        driver.quit()
+                    driver = None
+                except Exception as e:
+                    # the games without a result stay in the queue and are retried after the next sleep
+                    print(f'claiming failed: {e!r}')
+                    RUN_LOG.write('error', error=repr(e))
+                # the games of sales that ended are dropped too
+                watcher.settle(history, valid)
+                save_history(history_file, history)
+            if metrics_file is not None and len(due) + len(games) > 0:
+                METRICS.write(metrics_file, run_time)
+            RUN_LOG.flush()
+
+            watcher.set_activity('sleeping')
+            sleep(max(0, min(watcher.next_poll() - time(), SOURCES_FILE_CHECK)))
+    finally:
+        if driver is not None:
+            driver.quit()
+
+
 def main():
-    global SOURCES, HISTORY_KEYS, PROCESSED_GAMES
+    global SOURCES, HISTORY_KEYS, METRICS, PROFILE_PHASES, RUN_LOG
 
     run_time = int(time())
     script_name = os.path.basename(os.path.splitext(sys.argv[0])[0])
-    log_file = f'{script_name}.log.txt'
+    log_file = f'{script_name}.log.jsonl'
     default_history_file = f'{script_name}.history.json'
-    log(log_file, {'# new run': run_time})
+    default_browser_profile = f'{script_name}.firefox'
+    cache_file = f'{script_name}.cache.db'
 
     arg_parser = argparse.ArgumentParser(
         description=f'Claim free itch.io games in an itch.io sale/collection or reddit thread. \
                      Writes the results (game links, claimed games, ..) to history_file. Logs to {log_file}')
     arg_parser.add_argument('history_file', nargs='?', help=f'a json file generated by a previous run of this script (default: {default_history_file})')
     arg_parser.add_argument('--show-history', action='store_true', help='show summary of history in history_file and exit')
+    arg_parser.add_argument('--stats', action='store_true', help='print the counts of the summary of history_file as json and exit')
+    arg_parser.add_argument('--url-log', metavar='URL', help=f'show what happened to a game, sale, collection or reddit thread in all runs, from {log_file} and its compressed segments, and exit')
+    arg_parser.add_argument('--watch', metavar='SOURCES_FILE', help=f'keep running, poll the sources in SOURCES_FILE (one per line, optionally followed by its poll interval, e.g. 15m) and claim new games as soon as they are found, with the browser kept open; SOURCES_FILE is created from SOURCES if it does not exist (default interval: {POLL_INTERVAL}s)')
+    arg_parser.add_argument('--status-port', type=int, default=STATUS_PORT, help=f'with --watch, serve the status on http://localhost:PORT/status and the metrics on /metrics, 0 to disable (default: {STATUS_PORT})')
+    arg_parser.add_argument('--harvest', action='store_true', help='get game links and add the games to claim to the work queue next to history_file instead of claiming them, and merge the results of the claim workers into the history')
+    arg_parser.add_argument('--claim-worker', action='store_true', help='claim the games in the work queue next to history_file until it is empty, without loading or writing the history; several workers, on other machines too, can share the queue')
     arg_parser.add_argument('--recheck', action='store_true', help='reload game links from SOURCES')
+    arg_parser.add_argument('--rescan-threads', action='store_true', help='get all comments of reddit threads again instead of only the new ones')
+    arg_parser.add_argument('--no-batch-comments', action='store_true', help='get collapsed reddit comments one chain per request instead of in batches')
+    arg_parser.add_argument('--max-depth', type=int, default=FRONTIER_DEPTH, help=f'do not follow sales/collections found more than this many links away from SOURCES (default: {FRONTIER_DEPTH})')
     arg_parser.add_argument('--recheck-groups', action='store_true', help='reload game links from discovered itch collections / sales')
     arg_parser.add_argument('--enable-images', action='store_true', help='load images in the browser while claiming games')
     arg_parser.add_argument('--mute', action='store_true', help='automatically mute while claiming games')
+    arg_parser.add_argument('--headless', action='store_true', help='claim games without showing the browser, you need to be logged in from an earlier run')
+    arg_parser.add_argument('--browser-profile', default=default_browser_profile, help=f'firefox profile directory that keeps your itch login between runs (default: {default_browser_profile})')
+    arg_parser.add_argument('--no-browser-profile', action='store_true', help='use a new firefox profile and log in again')
+    arg_parser.add_argument('--no-blocking', action='store_true', help='let the browser load stylesheets, fonts, media and trackers, e.g. to solve a captcha')
     arg_parser.add_argument('--ignore', action='store_true', help='continue even if an error occurs when handling a game')
     arg_parser.add_argument('--skip-errors', action='store_true', help='do not retry games that caused an error previously')
+    arg_parser.add_argument('--max-requests', type=int, default=MAX_IN_FLIGHT, help=f'maximum number of requests running at the same time while getting game links (default: {MAX_IN_FLIGHT})')
+    arg_parser.add_argument('--workers', type=int, default=CLAIM_WORKERS, help=f'number of browsers claiming games at the same time, the extra browsers are headless and share your login (default: {CLAIM_WORKERS})')
+    arg_parser.add_argument('--claim-rate', type=float, default=CLAIM_RATE, help=f'starting rate of games claimed per second by all browsers, it adapts to itch (default: {CLAIM_RATE})')
+    arg_parser.add_argument('--view-rate', type=float, default=VIEW_RATE, help=f'starting rate of game pages visited per second by all browsers, it adapts to itch (default: {VIEW_RATE})')
+    arg_parser.add_argument('--no-preclassify', action='store_true', help='check every game in the browser instead of checking game pages over http first')
+    arg_parser.add_argument('--no-http-claim', action='store_true', help='claim every game in the browser instead of claiming over http with the browser\'s login')
+    arg_parser.add_argument('--no-library-sync', action='store_true', help='do not skip the games that are already in your itch library')
+    arg_parser.add_argument('--no-cache', action='store_true', help=f'do not use the cache of sale/collection pages and reddit threads in {cache_file}')
+    arg_parser.add_argument('--cache-size', type=int, default=CACHE_SIZE // 2**20, help=f'maximum size of the cache in MB (default: {CACHE_SIZE // 2**20})')
+    arg_parser.add_argument('--cache-ttl', type=float, default=0, help='use cached pages younger than this many seconds without checking if they changed, e.g. to work offline (default: 0)')
+    arg_parser.add_argument('--profile', choices=PROFILE_PHASES, help=f'profile a phase of the run with cProfile, the profile is written to {script_name}.PHASE.prof')
+    arg_parser.add_argument('--host-rate', type=float, default=HOST_RATE, help=f'starting rate of requests per second to the same host, it adapts to the responses (default: {HOST_RATE})')
     args = arg_parser.parse_args()
 
+    if args.url_log is not None:
+        for record in query_log(log_file, args.url_log):
+            details = {k: v for k, v in record.items() if k not in ('time', 'run', 'event', 'url', 'urls')}
+            print(f"{datetime.fromtimestamp(record['time']):%Y-%m-%d %H:%M:%S} run {record['run']} {record['event']} {json.dumps(details)}")
+        sys.exit(0)
+
     if args.history_file is not None:
         history_file = args.history_file
     else:
         history_file = default_history_file
+    # written next to the history file at the end of the run
+    metrics_file = os.path.splitext(history_file)[0] + '.metrics'
+    if args.profile is not None:
+        METRICS.profile = (args.profile, f'{script_name}.{args.profile}.prof')
+    work_queue = None
+    if args.harvest or args.claim_worker:
+        work_queue = WorkQueue(os.path.splitext(history_file)[0] + '.queue.db')
+    profile_dir = None if args.no_browser_profile else args.browser_profile
+
+    if args.show_history or args.stats:
+        # the summary written with the history is enough, unless the history file was changed since
+        summary = load_summary(history_file)
+        if summary is None and not os.path.exists(history_file):
+            # nothing is created
+            summary = summarize({k: set() for k in HISTORY_KEYS})
+        elif summary is None:
+            # --stats only prints json
+            with contextlib.redirect_stdout(sys.stderr if args.stats else sys.stdout):
+                summary = save_summary(history_file, load_history(history_file))
+        if args.stats:
+            print(json.dumps({'history_file': history_file, 'saved': summary.get('saved'), **summary['counts']}, indent=2))
+        else:
+            print_summary(history_file, summary)
+        sys.exit(0)
+
+    RUN_LOG.open(log_file, run_time)
+    RUN_LOG.write('run', argv=sys.argv[1:], pid=os.getpid(), history_file=history_file)
+
+    if args.claim_worker:
+        # the history is left to the harvest process, the results are only recorded in the queue
+        import socket
+        worker_name = f'{socket.gethostname()}:{os.getpid()}'
+        print(f'claiming the games in {work_queue.path} as {worker_name}, {work_queue.counts()}')
+        RUN_LOG.write('worker', work_queue=work_queue.path, worker=worker_name)
+        # other workers on this machine may use the profile, each one uses a copy with the login
+        worker_profile = None
+        if profile_dir is not None and os.path.exists(profile_dir):
+            worker_profile = copy_profile(profile_dir)
+        try:
+            with create_driver(args.enable_images, args.mute, args.headless, worker_profile, not args.no_blocking) as driver:
+                with METRICS.phase('login'):
+                    session = log_in(driver, args.headless)
+                with METRICS.phase('claim'):
+                    claim_with_workers(None, driver, None, args.workers, args.claim_rate,
+                                       args.ignore, args.enable_images, args.mute,
+                                       session=None if args.no_http_claim else session,
+                                       view_rate=args.view_rate, block=not args.no_blocking,
+                                       work_queue=work_queue, worker_name=worker_name)
+        finally:
+            if worker_profile is not None:
+                shutil.rmtree(worker_profile, ignore_errors=True)
+            print(f'work queue: {work_queue.counts()}')
+            # the metrics of workers are kept where they run
+            metrics_files = METRICS.write(f'{script_name}.worker.metrics', run_time)
+            RUN_LOG.write('end', metrics=metrics_files, phases=METRICS.phase_seconds())
+            RUN_LOG.flush()
+        return
+
     history = load_history(history_file)
-    log(log_file, {'history_file': history_file})
-    log(log_file, {k: len(v) for k, v in history.items()})
+    RUN_LOG.write('history', counts={k: len(v) for k, v in history.items()})
+
+    if args.watch is not None:
+        if not os.path.exists(args.watch):
+            with open(args.watch, 'w') as f:
+                f.write('# one source per line, optionally followed by its poll interval in seconds, or minutes / hours with m / h\n')
+                f.writelines(f'{source} {POLL_INTERVAL:g}\n' for source in sorted(SOURCES))
+            print(f'sources file created from SOURCES: {args.watch}')
+        load_sources(args.watch) # stop on an invalid file before starting the browser
+        cache = None
+        if not args.no_cache:
+            cache = HttpCache(cache_file, args.cache_size * 2**20, args.cache_ttl)
+        watcher = Watcher()
+        if args.status_port != 0:
+            serve_status(watcher, args.status_port)
+            print(f'status served on http://localhost:{args.status_port}/status')
+
+        def start_browser():
+            driver = create_driver(args.enable_images, args.mute, args.headless, profile_dir, not args.no_blocking)
+            try:
+                return driver, log_in(driver, args.headless)
+            except BaseException:
+                driver.quit()
+                raise
 
-    if args.show_history:
-        print_summary(history_file, history)
-        sys.exit(0)
+        def claim_games(games, driver, session, deadlines):
+            claim_with_workers(games, driver, history, args.workers, args.claim_rate,
+                               True, args.enable_images, args.mute,
+                               session=None if args.no_http_claim else session, deadlines=deadlines,
+                               view_rate=args.view_rate, block=not args.no_blocking)
 
-    # getting game links
-    itch_groups = set(filter(re.compile(PATTERNS['itch_group']).match, history['has_more']))
-    check_sources = not os.path.exists(history_file) or args.recheck
-    check_groups = len(itch_groups) > 0 or args.recheck_groups
-    if check_sources or check_groups:
-        print('will reload game urls from the internet')
-        # keep getting newly discovered sales/collections
-        first_pass = True
-        while True:
-            target_sources = set()
-            itch_groups = set(filter(re.compile(PATTERNS['itch_group']).match, history['has_more']))
-            if first_pass:
-                if check_sources:
-                    target_sources.update(SOURCES)
-                if args.recheck_groups:
-                    itch_groups.update(history['checked_groups'])
-            else:
-                if len(itch_groups) == 0:
-                    break
-                else:
-                    print('getting links from newly discovered sales/collections')
-            target_sources.update(itch_groups)
-            get_urls_and_update_history(history, target_sources, itch_groups)
-            first_pass = False
-            log(log_file, {'## got links': time(), 'sources': target_sources, 'urls': history['urls'], 'has_more': history['has_more']})
-    else:
-        print('using game urls saved in the history file')
-        print(' pass the option --recheck and/or --recheck-groups to reload game urls from the internet')
+        try:
+            watch(args.watch, history_file, history, Fetcher(args.max_requests, args.host_rate, cache),
+                  start_browser, claim_games, watcher, args.max_depth, not args.no_batch_comments, args.skip_errors,
+                  not args.no_preclassify, not args.no_library_sync, metrics_file, run_time)
+        except KeyboardInterrupt:
+            print('stopped watching')
+        finally:
+            print()
+            print_summary(history_file, save_history(history_file, history))
+            METRICS.write(metrics_file, run_time)
+            RUN_LOG.write('end', phases=METRICS.phase_seconds())
+            RUN_LOG.flush()
+        return
 
-    # claiming games
-    url = None
-    sleep_time = 15
     try:
-        ignore = set().union(*map(history.get, PROCESSED_GAMES))
-        if args.skip_errors:
-            ignore.update(history['error'])
-        valid = history['urls'].difference(ignore)
-        if len(valid) > 0:
-            with create_driver(args.enable_images, args.mute) as driver:
-                driver.get('https://itch.io/login')
-                # manually log in
-                input('A new Firefox window was opened. Log in to itch then click enter to continue')
-                for i, url in enumerate(valid):
-                    print(f"{i+1}/{len(valid)} ({len(history['urls'])})")
-                    if url not in ignore:
-                        try:
-                            result = claim(url, driver)
-                        except ParsingError as pe:
-                            if not args.ignore:
-                                raise
-                            history['error'].add(pe.url)
-                            print(f'Unknown Error: skipping {pe.url}')
-                        else:
-                            if url in history['error']:
-                                history['error'].remove(url)
-                                history['old_error'].add(url)
-                            if 'claimed' in result:
-                                history['claimed'].add(url)
-                            if 'web' in result:
-                                history['web'].add(url)
-                            if 'has_more' in result:
-                                history['has_more'].add(url)
-                            if 'buy' in result:
-                                history['buy'].add(url)
-                            if 'removed' in result:
-                                history['removed'].add(url)
-                            if 'always_free' in result:
-                                history['always_free'].add(url)
-                                continue
-                            if 'dl_only' in result:
-                                history['dl_only'].add(url)
-                            print(f' sleeping for {sleep_time}s')
-                        sleep(sleep_time)
-    except ParsingError as pe:
-        history['error'].add(pe.url)
-        raise
-    except Exception as e:
-        if url is not None:
-            history['error'].add(url)
-        raise
+        # getting game links
+        store = open_history_store(history_file)
+        frontier = Frontier(store.load_state('frontier'), args.max_depth)
+        itch_groups = set(filter(COMPILED_PATTERNS['itch_group'].match, history['has_more']))
+        check_sources = not os.path.exists(history_file) or args.recheck
+        check_groups = len(itch_groups) > 0 or args.recheck_groups
+        if check_sources or check_groups or len(frontier.pending()) > 0:
+            print('will reload game urls from the internet')
+            cache = None
+            if not args.no_cache:
+                cache = HttpCache(cache_file, args.cache_size * 2**20, args.cache_ttl)
+            fetcher = Fetcher(args.max_requests, args.host_rate, cache)
+            scan_states = dict() if args.rescan_threads else store.load_state('reddit', dict())
+            deadlines = store.load_state('deadlines', dict())
+            if len(frontier.pending()) > 0:
+                print(f'resuming {len(frontier.pending())} sources from the last run')
+            if check_sources:
+                for source in SOURCES:
+                    frontier.add(source, 0, 'source', recheck=True)
+            for group in itch_groups:
+                frontier.add(group)
+            if args.recheck_groups:
+                for group in history['checked_groups']:
+                    frontier.add(group, recheck=True)
+            for game in history['has_more'].difference(itch_groups):
+                if COMPILED_PATTERNS['itch_game'].match(game):
+                    frontier.add(game, kind='game')
+            with METRICS.phase('discovery'):
+                crawl_frontier(history, frontier, fetcher, store, scan_states, deadlines,
+                               batch=not args.no_batch_comments)
+            for host, stats in sorted(fetcher.stats.items()):
+                print(f"{host}: {stats['requests']} requests, {stats['bytes'] / 2**20:.1f}MB, "
+                      f"{stats['seconds'] / stats['requests']:.2f}s per request")
+            RUN_LOG.write('http', hosts=fetcher.stats)
+            if cache is not None:
+                print(f'http cache: {cache.stats}')
+                RUN_LOG.write('http cache', stats=cache.stats)
+        else:
+            print('using game urls saved in the history file')
+            print(' pass the option --recheck and/or --recheck-groups to reload game urls from the internet')
+
+        # claiming games
+        url = None
+        try:
+            if work_queue is not None:
+                results = work_queue.take_results()
+                for url, result, error in results:
+                    if error is not None:
+                        record_error(history, url, error)
+                    else:
+                        update_history(history, url, result)
+                url = None
+                print(f'merged {len(results)} results of the claim workers into the history')
+            deadlines = open_history_store(history_file).load_state('deadlines', dict())
+            games = unprocessed_games(history, args.skip_errors)
+            if work_queue is not None:
+                # the login of the browser profile, if there is one, so the games the user owns can be told apart
+                session = None if profile_dir is None else session_from_profile(profile_dir)
+                if session is not None and not is_logged_in(session):
+                    session = None
+                owned = None
+                if session is None:
+                    print('not logged in to itch, the claim workers check the games that could be owned')
+                elif not args.no_library_sync:
+                    print('getting the games in your library')
+                    with METRICS.phase('library'):
+                        owned = get_owned_games(session, Fetcher(args.max_requests, args.host_rate))
+                valid = games_to_claim(history, games, deadlines, Fetcher(args.max_requests, args.host_rate),
+                                       not args.no_preclassify, session, owned)
+                added = work_queue.enqueue(valid, deadlines)
+                print(f'added {added} games to the work queue {work_queue.path}, {work_queue.counts()}')
+                print(f' run {script_name} {history_file} --claim-worker to claim them')
+            elif len(games) > 0:
+                with create_driver(args.enable_images, args.mute, args.headless, profile_dir, not args.no_blocking) as driver:
+                    # logged in before the game pages are checked, they look different for the games the user owns
+                    with METRICS.phase('login'):
+                        session = log_in(driver, args.headless)
+                    # right after the login, the games in the library aren't visited
+                    owned = None
+                    if not args.no_library_sync:
+                        print('getting the games in your library')
+                        with METRICS.phase('library'):
+                            owned = get_owned_games(session, Fetcher(args.max_requests, args.host_rate))
+                    valid = games_to_claim(history, games, deadlines, Fetcher(args.max_requests, args.host_rate),
+                                           not args.no_preclassify, session, owned)
+                    if len(valid) > 0:
+                        with METRICS.phase('claim'):
+                            claim_with_workers(valid, driver, history, args.workers, args.claim_rate,
+                                               args.ignore, args.enable_images, args.mute,
+                                               session=None if args.no_http_claim else session, deadlines=deadlines,
+                                               view_rate=args.view_rate, block=not args.no_blocking)
+        except ParsingError as pe:
+            record_error(history, pe.url, pe)
+            raise
+        except Exception as e:
+            if url is not None:
+                record_error(history, url, e)
+            raise
     finally:
         print()
-        save_history(history_file, history)
-        print_summary(history_file, history)
+        print_summary(history_file, save_history(history_file, history))
+        phases = METRICS.phase_seconds()
+        if len(phases) > 0:
+            print('time per phase: ' + ' | '.join(f'{phase} {seconds:.1f}s' for phase, seconds in phases.items()))
+        metrics_files = METRICS.write(metrics_file, run_time)
+        print(f"metrics written to {' and '.join(metrics_files)}")
+        RUN_LOG.write('end', metrics=metrics_files, phases=phases)
+        RUN_LOG.flush()
 
 
 if __name__ == '__main__':